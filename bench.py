@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks that don't need the network.
+
+python bench.py loop - compare event loops on a synthetic check workload.
+python bench.py farm - run ProxyScraperChecker.main() against a local farm
+of fake proxies (Linux only), see "python bench.py farm --help".
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+import raw_engine
+from farm import FarmOptions, ProxyFarm
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+JUDGE_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\nConnection: close\r\n\r\n"
+    + b"127.0.0.1\n"
+)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values, 0 if there are none."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def _serve_socks5_judge(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """SOCKS5 proxy that answers the judge request itself."""
+    try:
+        greeting = await reader.readexactly(2)
+        await reader.readexactly(greeting[1])
+        writer.write(b"\x05\x00")
+        await reader.readexactly(10)
+        writer.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(JUDGE_RESPONSE)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _run_synthetic_checks(
+    checks: int, concurrency: int
+) -> Tuple[float, List[float]]:
+    """Check a local fake SOCKS5 proxy with the raw engine.
+
+    Returns:
+        Elapsed seconds and sorted latencies of successful checks.
+    """
+    server = await asyncio.start_server(
+        _serve_socks5_judge, "127.0.0.1", 0, backlog=concurrency
+    )
+    port = server.sockets[0].getsockname()[1]
+    judge = raw_engine.Judge(
+        "127.0.0.1",
+        "127.0.0.1",
+        port,
+        False,
+        b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n",
+    )
+    latencies: List[float] = []
+    remaining = iter(range(checks))
+
+    async def worker() -> None:
+        for _ in remaining:
+            start = perf_counter()
+            try:
+                await raw_engine.check("127.0.0.1", port, "socks5", judge)
+            except Exception:
+                continue
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    return elapsed, latencies
+
+
+def get_loop_policies() -> List[Tuple[str, asyncio.AbstractEventLoopPolicy]]:
+    """The default event loop and uvloop if it is installed."""
+    policies: List[Tuple[str, asyncio.AbstractEventLoopPolicy]] = [
+        ("asyncio", asyncio.DefaultEventLoopPolicy())
+    ]
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        policies.append(("uvloop", uvloop.EventLoopPolicy()))
+    return policies
+
+
+def bench_loops(
+    checks: int = 10000,
+    concurrency: int = 256,
+    console: Optional[Console] = None,
+) -> None:
+    """Run the same synthetic check workload on every available loop.
+
+    Args:
+        checks (int): Number of checks per loop.
+        concurrency (int): Number of simultaneous checks.
+    """
+    console = console or Console()
+    table = Table(title=f"{checks} checks, {concurrency} at a time")
+    table.add_column("Loop", style="cyan")
+    table.add_column("Checks/s", style="magenta")
+    table.add_column("p50, ms", style="green")
+    table.add_column("p99, ms", style="green")
+    table.add_column("Failed", style="red")
+    original = asyncio.get_event_loop_policy()
+    policies = get_loop_policies()
+    try:
+        for name, policy in policies:
+            asyncio.set_event_loop_policy(policy)
+            elapsed, latencies = asyncio.run(
+                _run_synthetic_checks(checks, concurrency)
+            )
+            table.add_row(
+                name,
+                f"{len(latencies) / elapsed:.0f}",
+                f"{percentile(latencies, 0.5) * 1000:.2f}",
+                f"{percentile(latencies, 0.99) * 1000:.2f}",
+                str(checks - len(latencies)),
+            )
+    finally:
+        asyncio.set_event_loop_policy(original)
+    console.print(table)
+    if len(policies) == 1:
+        console.print("[yellow]uvloop is not installed.[/yellow]")
+
+
+def get_peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def count_fds() -> Optional[int]:
+    """Number of open file descriptors of this process."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+async def _sample_fds(peak: List[int], interval: float = 0.05) -> None:
+    while True:
+        fds = count_fds()
+        if fds is None:
+            return
+        peak[0] = max(peak[0], fds)
+        await asyncio.sleep(interval)
+
+
+async def _run_checker(
+    farm: ProxyFarm, checker_options: Dict[str, Any]
+) -> Tuple[float, int, List[float], int, Optional[int]]:
+    """Run the checker against the farm in a temporary directory.
+
+    Returns:
+        Elapsed seconds, number of checked proxies, sorted latencies of
+        working proxies, number of working proxies and peak fds.
+    """
+    # Imported here, so "bench.py loop" works without the checker's deps.
+    from main import ProxyScraperChecker
+
+    checker = ProxyScraperChecker(
+        ip_service=farm.ip_service,
+        http_sources=farm.get_source("http"),
+        socks4_sources=farm.get_source("socks4"),
+        socks5_sources=farm.get_source("socks5"),
+        console=Console(quiet=True),
+        **checker_options,
+    )
+    peak_fds = [count_fds() or 0]
+    sampler = asyncio.ensure_future(_sample_fds(peak_fds))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            start = perf_counter()
+            await checker.main()
+            elapsed = perf_counter() - start
+            if checker.cleanup is not None:
+                checker.cleanup.join()
+        finally:
+            os.chdir(cwd)
+            sampler.cancel()
+    # Without the time spent waiting for a free connection.
+    latencies = sorted(
+        latency.total if latency.ttfb is None else latency.ttfb
+        for proto_latencies in checker.latencies.values()
+        for latency in proto_latencies.values()
+    )
+    return (
+        elapsed,
+        sum(checker.proxies_count.values()),
+        latencies,
+        sum(map(len, checker.proxies.values())),
+        peak_fds[0] or None,
+    )
+
+
+def bench_farm(
+    options: FarmOptions = FarmOptions(),
+    farm_processes: int = 1,
+    checker_options: Optional[Dict[str, Any]] = None,
+    console: Optional[Console] = None,
+) -> None:
+    """Check a local farm of fake proxies end to end.
+
+    Args:
+        options (FarmOptions): Number of proxies and how they behave.
+        farm_processes (int): Number of processes serving the farm.
+        checker_options (dict): ProxyScraperChecker arguments, e.g.
+            timeout, max_connections, engine. Peak RSS and fds are those of
+            this process, worker processes of workers > 1 aren't counted.
+    """
+    console = console or Console()
+    with ProxyFarm(options, farm_processes) as farm:
+        expected = sum(len(farm.get_working(proto)) for proto in farm.proxies)
+        elapsed, checks, latencies, working, peak_fds = asyncio.run(
+            _run_checker(farm, checker_options or {})
+        )
+    peak_rss = get_peak_rss()
+    table = Table(
+        title=f"{checks} proxies, {expected} working, "
+        + f"{options.tarpit:.0%} tarpits, {options.drop:.0%} drops"
+    )
+    table.add_column("Checks/s", style="magenta")
+    table.add_column("p50, ms", style="green")
+    table.add_column("p99, ms", style="green")
+    table.add_column("Working", style="cyan")
+    table.add_column("Peak RSS, MiB", style="yellow")
+    table.add_column("Peak fds", style="yellow")
+    table.add_column("Elapsed, s", style="yellow")
+    table.add_row(
+        f"{checks / elapsed:.0f}",
+        f"{percentile(latencies, 0.5) * 1000:.2f}",
+        f"{percentile(latencies, 0.99) * 1000:.2f}",
+        f"{working}/{expected}",
+        "-" if peak_rss is None else f"{peak_rss / 2**20:.1f}",
+        "-" if peak_fds is None else str(peak_fds),
+        f"{elapsed:.2f}",
+    )
+    console.print(table)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    loop = subparsers.add_parser("loop", help="compare event loops")
+    loop.add_argument("--checks", type=int, default=10000)
+    loop.add_argument("--concurrency", type=int, default=256)
+    farm = subparsers.add_parser(
+        "farm", help="check a local farm of fake proxies end to end"
+    )
+    defaults = FarmOptions()
+    farm.add_argument(
+        "--proxies",
+        type=int,
+        default=defaults.proxies,
+        help="proxies of every protocol (default: %(default)s)",
+    )
+    farm.add_argument(
+        "--working",
+        type=float,
+        default=defaults.working,
+        help="share of working proxies (default: %(default)s)",
+    )
+    farm.add_argument(
+        "--tarpit",
+        type=float,
+        default=defaults.tarpit,
+        help="share of proxies that never answer (default: %(default)s)",
+    )
+    farm.add_argument(
+        "--drop",
+        type=float,
+        default=defaults.drop,
+        help="share of dropped connections to working proxies"
+        + " (default: %(default)s)",
+    )
+    farm.add_argument(
+        "--latency",
+        type=float,
+        default=defaults.latency,
+        help="mean delay of proxies in seconds (default: %(default)s)",
+    )
+    farm.add_argument(
+        "--farm-processes",
+        type=int,
+        default=1,
+        help="processes serving the farm (default: %(default)s)",
+    )
+    farm.add_argument("--timeout", type=float, default=2)
+    farm.add_argument("--max-connections", type=int, default=950)
+    farm.add_argument("--engine", choices=("aiohttp", "raw"), default="raw")
+    farm.add_argument("--funnel", action="store_true")
+    farm.add_argument("--pipeline", action="store_true")
+    farm.add_argument("--adaptive-concurrency", action="store_true")
+    farm.add_argument("--high-concurrency", action="store_true")
+    farm.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    if args.command == "loop":
+        bench_loops(args.checks, args.concurrency)
+    elif args.command == "farm":
+        bench_farm(
+            FarmOptions(
+                args.proxies,
+                args.working,
+                args.tarpit,
+                args.drop,
+                args.latency,
+            ),
+            args.farm_processes,
+            {
+                "timeout": args.timeout,
+                "max_connections": args.max_connections,
+                "engine": args.engine,
+                "funnel": args.funnel,
+                "pipeline": args.pipeline,
+                "adaptive_concurrency": args.adaptive_concurrency,
+                "high_concurrency": args.high_concurrency,
+                "workers": args.workers,
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,14 +6,114 @@
 TIMEOUT = 10
 
 # Maximum concurrent connections.
-# Don't set higher than 950, please.
+# Don't set higher than 950 without ADAPTIVE_CONCURRENCY, please.
 MAX_CONNECTIONS = 950
 
+# Adjust the number of concurrent connections automatically between
+# MIN_CONNECTIONS and MAX_CONNECTIONS (True or False). It grows while
+# checks go well and backs off on "Too many open files" and similar
+# errors, rising latency or an overloaded event loop.
+ADAPTIVE_CONCURRENCY = False
+MIN_CONNECTIONS = 16
+
+# Linux and macOS only (True or False). Raise the open files limit as high
+# as the system allows and derive MAX_CONNECTIONS and the FUNNEL stage
+# connections from it, for tens of thousands of simultaneous checks.
+# Works best with ENGINE = "raw".
+HIGH_CONCURRENCY = False
+# Upper bound of the derived MAX_CONNECTIONS. Hard limits are often
+# around a million, and every check in flight costs memory.
+HIGH_CONCURRENCY_LIMIT = 50000
+
+# Start checking proxies while the sources are still being scraped
+# (True or False). Otherwise checking starts after all sources are scraped.
+PIPELINE = False
+
+# Checking engine: "aiohttp" or "raw".
+# "raw" does the SOCKS4/SOCKS5/HTTP CONNECT handshake itself on top of
+# asyncio sockets and handles many more concurrent checks per process.
+ENGINE = "aiohttp"
+
+# Check proxies in stages (True or False): a cheap TCP connect first,
+# then only the proxy handshake, and only the survivors get the full
+# request to IP_SERVICE. Dead proxies are dropped in CONNECT_TIMEOUT
+# seconds instead of holding a connection for TIMEOUT seconds.
+FUNNEL = False
+# Timeouts and maximum concurrent connections of the first two stages
+# (None for a third of MAX_CONNECTIONS). A connection that passed a stage
+# stays open while it waits for the next one, so all stages share
+# MAX_CONNECTIONS: the last stage uses TIMEOUT and what the first two left.
+CONNECT_TIMEOUT = 2
+CONNECT_CONNECTIONS = None
+HANDSHAKE_TIMEOUT = 3
+HANDSHAKE_CONNECTIONS = None
+
+# Number of processes to check proxies in. Every process checks its own
+# shard of proxies with its own MAX_CONNECTIONS, so set it up to the number
+# of CPU cores. More than 1 disables PIPELINE.
+# Can be overridden with "python main.py --workers N".
+WORKERS = 1
+
+# Use uvloop instead of the default event loop if it is installed
+# (True or False). Install it with "pip install uvloop" (not on Windows).
+# Can be enabled with "python main.py --uvloop".
+# "python main.py --bench-loop" compares both loops on your machine.
+UVLOOP = False
+
+# SQLite file to remember check results between runs in (or None).
+# Proxies that were alive recently are checked first (with PIPELINE, first
+# among proxies of the same source). Proxies that failed HISTORY_MAX_FAILURES
+# checks in a row are skipped, except for a random HISTORY_REPROBE share of
+# them (0.1 is 10%).
+HISTORY = None
+HISTORY_MAX_FAILURES = 5
+HISTORY_REPROBE = 0.1
+
+# Incremental mode, requires HISTORY. Proxies verified alive less than
+# this many seconds ago are saved without checking them again, only new
+# and expired proxies are checked. None to check everything.
+INCREMENTAL_TTL = None
+
+# JSON file to cache proxy lists of sources in (or None). Sources are
+# requested with If-None-Match/If-Modified-Since, and lists that didn't
+# change since the last run are not parsed again.
+SOURCE_CACHE = None
+
+# Sort output files (True or False). False writes proxies in the order they
+# were scraped in and saves the time of sorting huge lists.
+SORT_PROXIES = True
+
+# Sort output files by latency, fastest proxies first (True or False).
+# Otherwise they are sorted by ip:port. Timings of every proxy are saved
+# to the proxies_latency folder in ip:port::Connect::Handshake::TTFB
+# format, in milliseconds. Connect and Handshake are measured with
+# ENGINE = "raw" or FUNNEL = True, otherwise they are None.
+SORT_BY_LATENCY = False
+
 # Add geolocation info for each proxy (True or False).
 # Output format is ip:port::Country::Region::City
 GEOLOCATION = True
 
+# How to open GeoLite2-City.mmdb: "auto" (the C extension if it is
+# installed, otherwise "mmap"), "mmap_ext", "mmap", "memory" (read the
+# whole file into memory) or "file" (least memory, slowest).
+GEOLOCATION_MODE = "auto"
+
+# JSON file to keep geolocation of exit node networks in between runs
+# (or None). It is rebuilt when GeoLite2-City.mmdb is updated.
+GEOLOCATION_CACHE = None
+
+# Port to serve Prometheus metrics on at http://METRICS_HOST:port/metrics
+# while the checker is running (or None): scraped, duplicate, checked,
+# alive and failed proxies, check durations, checks in flight and waiting
+# for a connection, fetch duration and size of every source.
+# Use METRICS_HOST = "0.0.0.0" to scrape it from other machines.
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
 # Service for checking the IP address.
+# "python judge.py" runs a local one at http://127.0.0.1:8080/ for
+# offline checks and load tests.
 IP_SERVICE = "https://checkip.amazonaws.com"
 
 # PROTOCOL - whether to enable checking certain protocol proxies (True or False).
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Fake HTTP, SOCKS4 and SOCKS5 proxies on loopback for benchmarks.
+
+Every proxy has its own 127.x.y.z address, but all proxies of a protocol
+share one listening socket: the address a client connected to decides how
+the proxy behaves. Working proxies really tunnel to the bundled judge, the
+others are dead, tarpits or randomly drop connections. Linux only, other
+systems route only 127.0.0.1 to loopback by default.
+
+The farm runs in its own processes, so it doesn't compete with the
+checker for its event loop.
+"""
+import asyncio
+import multiprocessing
+import socket
+from ipaddress import IPv4Address
+from random import random
+from struct import unpack
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+from zlib import crc32
+
+from judge import JudgeProtocol
+from limiter import raise_fd_limit
+
+# First addresses of proxies of every protocol, up to 65536 each.
+NETWORKS = {
+    "http": int(IPv4Address("127.1.0.0")),
+    "socks4": int(IPv4Address("127.2.0.0")),
+    "socks5": int(IPv4Address("127.3.0.0")),
+}
+
+# (host, port, bytes to send to the target once connected)
+Target = Tuple[str, int, bytes]
+
+
+class FarmOptions(NamedTuple):
+    # Number of proxies of every protocol.
+    proxies: int = 1000
+    # Share of working proxies, the rest are dead or tarpits.
+    working: float = 0.3
+    # Share of tarpits that accept connections and never answer.
+    tarpit: float = 0.1
+    # Share of connections to working proxies that are dropped.
+    drop: float = 0.0
+    # Mean delay in seconds before a proxy answers, every proxy gets its own
+    # between 0.5 and 1.5 of it.
+    latency: float = 0.05
+
+
+def get_behaviour(ip: str, options: FarmOptions) -> Tuple[str, float]:
+    """How the proxy at the address behaves, stable between runs.
+
+    Returns:
+        "working", "tarpit" or "dead" and the proxy's delay in seconds.
+    """
+    kind = crc32(ip.encode()) / 2**32
+    speed = crc32(ip.encode(), 1) / 2**32
+    delay = options.latency * (0.5 + speed)
+    if kind < options.working:
+        return "working", delay
+    if kind < options.working + options.tarpit:
+        return "tarpit", delay
+    return "dead", delay
+
+
+def get_proxies(proto: str, port: int, options: FarmOptions) -> List[str]:
+    """ip:port of all proxies of the protocol."""
+    network = NETWORKS[proto]
+    return [
+        f"{IPv4Address(network + i)}:{port}"
+        for i in range(1, options.proxies + 1)
+    ]
+
+
+async def _socks4_handshake(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float
+) -> Target:
+    request = await reader.readexactly(8)
+    if request[:2] != b"\x04\x01":
+        raise ValueError("Not a SOCKS4 CONNECT")
+    (port,) = unpack(">H", request[2:4])
+    host = socket.inet_ntoa(request[4:8])
+    await reader.readuntil(b"\x00")
+    if host.startswith("0.0.0.") and host != "0.0.0.0":
+        host = (await reader.readuntil(b"\x00"))[:-1].decode()
+    await asyncio.sleep(delay)
+    writer.write(b"\x00\x5a" + request[2:8])
+    return host, port, b""
+
+
+async def _socks5_handshake(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float
+) -> Target:
+    greeting = await reader.readexactly(2)
+    if greeting[0] != 5:
+        raise ValueError("Not SOCKS5")
+    await reader.readexactly(greeting[1])
+    writer.write(b"\x05\x00")
+    request = await reader.readexactly(4)
+    if request[:2] != b"\x05\x01":
+        raise ValueError("Not a SOCKS5 CONNECT")
+    if request[3] == 1:
+        host = socket.inet_ntoa(await reader.readexactly(4))
+    elif request[3] == 3:
+        length = await reader.readexactly(1)
+        host = (await reader.readexactly(length[0])).decode()
+    else:
+        raise ValueError(f"Unsupported address type {request[3]}")
+    (port,) = unpack(">H", await reader.readexactly(2))
+    await asyncio.sleep(delay)
+    writer.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+    return host, port, b""
+
+
+async def _http_handshake(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float
+) -> Target:
+    head = await reader.readuntil(b"\r\n\r\n")
+    method, target, _ = head.split(b"\r\n", 1)[0].decode().split(" ", 2)
+    await asyncio.sleep(delay)
+    if method == "CONNECT":
+        host, port = target.rsplit(":", 1)
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        return host, int(port), b""
+    # Plain HTTP requests come with the absolute URL and are forwarded as is.
+    parts = urlsplit(target)
+    if not parts.hostname:
+        raise ValueError(f"Not a proxy request: {target}")
+    return parts.hostname, parts.port or 80, head
+
+
+HANDSHAKES: Dict[
+    str,
+    Callable[
+        [asyncio.StreamReader, asyncio.StreamWriter, float], Awaitable[Target]
+    ],
+] = {
+    "http": _http_handshake,
+    "socks4": _socks4_handshake,
+    "socks5": _socks5_handshake,
+}
+
+
+async def _pipe(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _serve_proxy(
+    proto: str,
+    options: FarmOptions,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    peer = writer.get_extra_info("peername")
+    ip = writer.get_extra_info("sockname")[0]
+    # The listening socket is bound to all interfaces, serve loopback only.
+    if not peer or not peer[0].startswith("127."):
+        writer.transport.abort()
+        return
+    kind, delay = get_behaviour(ip, options)
+    if kind == "dead" or (kind == "working" and random() < options.drop):
+        writer.transport.abort()
+        return
+    try:
+        if kind == "tarpit":
+            await reader.read()
+            return
+        host, port, data = await HANDSHAKES[proto](reader, writer, delay)
+        target_reader, target_writer = await asyncio.open_connection(
+            host, port
+        )
+        target_writer.write(data)
+        await asyncio.gather(
+            _pipe(reader, target_writer),
+            _pipe(target_reader, writer),
+            return_exceptions=True,
+        )
+    except (
+        OSError,
+        ValueError,
+        asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError,
+    ):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_sources(
+    sources: Dict[str, bytes],
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        path = head.split(b" ", 2)[1].decode()
+        body = sources.get(path.strip("/").rsplit(".", 1)[0])
+        if body is None:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n")
+        else:
+            writer.write(
+                f"HTTP/1.1 200 OK\r\nContent-Length: {len(body)}\r\n".encode()
+            )
+        writer.write(b"Content-Type: text/plain\r\nConnection: close\r\n\r\n")
+        if body is not None:
+            writer.write(body)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_farm(
+    sockets: Dict[str, socket.socket],
+    sources: Dict[str, bytes],
+    options: FarmOptions,
+) -> None:
+    loop = asyncio.get_running_loop()
+    await loop.create_server(JudgeProtocol, sock=sockets["judge"])
+    await asyncio.start_server(
+        lambda r, w: _serve_sources(sources, r, w), sock=sockets["sources"]
+    )
+    for proto in HANDSHAKES:
+
+        def handle(
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            proto: str = proto,
+        ) -> Awaitable[None]:
+            return _serve_proxy(proto, options, reader, writer)
+
+        await asyncio.start_server(handle, sock=sockets[proto])
+    await loop.create_future()
+
+
+def serve_farm(
+    sockets: Dict[str, socket.socket],
+    sources: Dict[str, bytes],
+    options: FarmOptions,
+) -> None:
+    """Entry point of farm processes."""
+    raise_fd_limit()
+    asyncio.run(_serve_farm(sockets, sources, options))
+
+
+class ProxyFarm:
+    def __init__(
+        self, options: FarmOptions = FarmOptions(), processes: int = 1
+    ) -> None:
+        """Start with "with ProxyFarm(...) as farm:".
+
+        Args:
+            options (FarmOptions): How many proxies and how they behave.
+            processes (int): Number of processes serving the farm.
+        """
+        if options.proxies > 65535:
+            raise ValueError("At most 65535 proxies of every protocol")
+        self.options = options
+        self.PROCESSES = processes
+        self.sockets: Dict[str, socket.socket] = {}
+        self.processes: List[multiprocessing.Process] = []
+        self.proxies: Dict[str, List[str]] = {}
+
+    @property
+    def ip_service(self) -> str:
+        return f"http://127.0.0.1:{self._get_port('judge')}/"
+
+    def get_source(self, proto: str) -> str:
+        """URL of the list of all proxies of the protocol."""
+        return f"http://127.0.0.1:{self._get_port('sources')}/{proto}.txt"
+
+    def get_working(self, proto: str) -> List[str]:
+        """ip:port of proxies of the protocol that should pass the check."""
+        return [
+            proxy
+            for proxy in self.proxies[proto]
+            if get_behaviour(proxy.split(":")[0], self.options)[0] == "working"
+        ]
+
+    def start(self) -> None:
+        self.sockets = {
+            "judge": self._listen("127.0.0.1"),
+            "sources": self._listen("127.0.0.1"),
+        }
+        for proto in HANDSHAKES:
+            self.sockets[proto] = self._listen("0.0.0.0")
+            self.proxies[proto] = get_proxies(
+                proto, self._get_port(proto), self.options
+            )
+        sources = {
+            proto: "\n".join(proxies).encode()
+            for proto, proxies in self.proxies.items()
+        }
+        for _ in range(self.PROCESSES):
+            process = multiprocessing.Process(
+                target=serve_farm,
+                args=(self.sockets, sources, self.options),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def stop(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        for sock in self.sockets.values():
+            sock.close()
+        self.processes.clear()
+        self.sockets.clear()
+
+    def __enter__(self) -> "ProxyFarm":
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+    def _get_port(self, name: str) -> int:
+        port: int = self.sockets[name].getsockname()[1]
+        return port
+
+    @staticmethod
+    def _listen(host: str) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, 0))
+        sock.listen(socket.SOMAXCONN)
+        return sock
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Geolocation of networks from previous runs, stored in a JSON file."""
+import json
+import os
+import socket
+from typing import Dict, List, Optional
+
+
+def _to_int(ip: str) -> Optional[int]:
+    try:
+        return int.from_bytes(socket.inet_aton(ip), "big")
+    except OSError:
+        return None
+
+
+class GeolocationCache:
+    def __init__(self, path: Optional[str], build_epoch: int) -> None:
+        """Load the cache if it was made with the same database.
+
+        Entries are whole networks as returned by
+        Reader.get_with_prefix_len(), so one lookup covers every IPv4
+        address of the network. A missing or broken file, or one from
+        another database build, is an empty cache.
+
+        Args:
+            path (str): Path to the JSON file, None to cache in memory only.
+            build_epoch (int): build_epoch from the mmdb metadata.
+        """
+        self.path = path
+        self.build_epoch = build_epoch
+        # prefix length -> network address >> (32 - prefix length) -> value
+        self.networks: Dict[int, Dict[int, str]] = {}
+        self._prefix_lens: List[int] = []
+        if path is None:
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data["build_epoch"] != build_epoch:
+                return
+            self.networks = {
+                int(prefix_len): {
+                    int(network): value for network, value in networks.items()
+                }
+                for prefix_len, networks in data["networks"].items()
+            }
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            self.networks = {}
+        self._prefix_lens = sorted(self.networks, reverse=True)
+
+    def get(self, ip: str) -> Optional[str]:
+        """Cached value of the network the IPv4 address belongs to."""
+        address = _to_int(ip)
+        if address is None:
+            return None
+        for prefix_len in self._prefix_lens:
+            value = self.networks[prefix_len].get(address >> 32 - prefix_len)
+            if value is not None:
+                return value
+        return None
+
+    def set(self, ip: str, prefix_len: int, value: str) -> None:
+        """Cache the value for the whole network of the IPv4 address."""
+        address = _to_int(ip)
+        if address is None or not 0 <= prefix_len <= 32:
+            return
+        if prefix_len not in self.networks:
+            self.networks[prefix_len] = {}
+            self._prefix_lens = sorted(self.networks, reverse=True)
+        self.networks[prefix_len][address >> 32 - prefix_len] = value
+
+    def save(self) -> None:
+        """Write the cache to a temporary file and replace the old one."""
+        if self.path is None:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"build_epoch": self.build_epoch, "networks": self.networks},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp, self.path)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Results of previous runs, stored in SQLite."""
+import sqlite3
+from time import time
+from typing import Dict, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+
+# Timings of the last successful check in seconds, like main.Latency
+# without the time spent waiting for a connection.
+Timings = Tuple[Optional[float], Optional[float], Optional[float]]
+
+
+class Record(NamedTuple):
+    last_checked: float
+    last_alive: Optional[float]
+    failures: int
+    # Time to first byte.
+    latency: Optional[float]
+    exit_node: Optional[str]
+    source: Optional[str]
+    connect: Optional[float] = None
+    handshake: Optional[float] = None
+
+
+class ProxyHistory:
+    def __init__(self, path: str) -> None:
+        """Open or create the history database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                proto TEXT NOT NULL,
+                proxy TEXT NOT NULL,
+                last_checked REAL NOT NULL,
+                last_alive REAL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                latency REAL,
+                exit_node TEXT,
+                source TEXT,
+                PRIMARY KEY (proto, proxy)
+            ) WITHOUT ROWID
+            """
+        )
+        # Added later, databases of older versions don't have them.
+        columns = {
+            row[1] for row in self.db.execute("PRAGMA table_info(history)")
+        }
+        for column in ("connect", "handshake"):
+            if column not in columns:
+                self.db.execute(
+                    f"ALTER TABLE history ADD COLUMN {column} REAL"
+                )
+
+    def load(self, proto: str) -> Dict[str, Record]:
+        """Get records of all proxies of the protocol, keyed by ip:port."""
+        return {
+            row[0]: Record(*row[1:])
+            for row in self.db.execute(
+                "SELECT proxy, last_checked, last_alive, failures, latency,"
+                + " exit_node, source, connect, handshake FROM history"
+                + " WHERE proto = ?",
+                (proto,),
+            )
+        }
+
+    def record(
+        self,
+        proto: str,
+        alive: Mapping[str, Tuple[str, Timings]],
+        dead: Iterable[str],
+        sources: Mapping[str, str],
+        now: Optional[float] = None,
+    ) -> None:
+        """Save results of a run.
+
+        Args:
+            proto (str): http/socks4/socks5.
+            alive (Mapping): ip:port -> (exit node, (connect, handshake,
+                ttfb)) of working proxies.
+            dead (Iterable): ip:port of proxies that failed the check.
+            sources (Mapping): ip:port -> source URL the proxy was found in.
+        """
+        now = time() if now is None else now
+        dead = list(dead)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO history (proto, proxy, last_checked)"
+                + " VALUES (?, ?, ?)",
+                ((proto, proxy, now) for proxy in (*alive, *dead)),
+            )
+            self.db.executemany(
+                "UPDATE history SET last_checked = ?, last_alive = ?,"
+                + " failures = 0, latency = ?, exit_node = ?,"
+                + " source = COALESCE(?, source), connect = ?, handshake = ?"
+                + " WHERE proto = ? AND proxy = ?",
+                (
+                    (
+                        now,
+                        now,
+                        ttfb,
+                        exit_node,
+                        sources.get(proxy),
+                        connect,
+                        handshake,
+                        proto,
+                        proxy,
+                    )
+                    for proxy, (
+                        exit_node,
+                        (connect, handshake, ttfb),
+                    ) in alive.items()
+                ),
+            )
+            self.db.executemany(
+                "UPDATE history SET last_checked = ?, failures = failures + 1,"
+                + " source = COALESCE(?, source)"
+                + " WHERE proto = ? AND proxy = ?",
+                ((now, sources.get(proxy), proto, proxy) for proxy in dead),
+            )
+
+    def close(self) -> None:
+        self.db.close()
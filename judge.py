@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Minimal judge server to use as IP_SERVICE without the internet.
+
+It answers every request with the client's IP, which is the proxy's exit
+node when the request comes through a proxy, and closes the connection.
+With ?headers in the query string it answers with JSON that also has the
+request headers, e.g. to see what a proxy adds to requests.
+
+python judge.py - serve http://127.0.0.1:8080/
+python judge.py --tls-port 8443 --cert cert.pem --key key.pem - also serve
+https://127.0.0.1:8443/. A self-signed certificate has to be trusted by
+the checker, e.g. with SSL_CERT_FILE=cert.pem.
+"""
+import argparse
+import asyncio
+import json
+import ssl
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from rich.console import Console
+
+# Requests with larger headers are rejected.
+MAX_REQUEST_SIZE = 8192
+
+
+class JudgeProtocol(asyncio.Protocol):
+    """One connection, one response.
+
+    A bare protocol instead of streams, so the judge isn't the bottleneck
+    when the checker is benchmarked on loopback.
+    """
+
+    def __init__(self) -> None:
+        self.transport: Optional[asyncio.Transport] = None
+        self.ip = ""
+        self.buffer = bytearray()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+        peername = transport.get_extra_info("peername")
+        self.ip = peername[0] if peername else ""
+
+    def data_received(self, data: bytes) -> None:
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.buffer += data
+        end = self.buffer.find(b"\r\n\r\n")
+        if end == -1:
+            if len(self.buffer) > MAX_REQUEST_SIZE:
+                self.respond(431, b"", "text/plain")
+            return
+        self.respond(*get_response(self.ip, bytes(self.buffer[:end])))
+
+    def respond(self, status: int, body: bytes, content_type: str) -> None:
+        if self.transport is None:
+            return
+        reason = {
+            200: "OK",
+            400: "Bad Request",
+            431: "Request Header Fields Too Large",
+        }[status]
+        self.transport.write(
+            (
+                f"HTTP/1.1 {status} {reason}\r\nContent-Length: {len(body)}"
+                + f"\r\nContent-Type: {content_type}\r\nConnection: close"
+                + "\r\n\r\n"
+            ).encode()
+            + body
+        )
+        self.transport.close()
+
+
+def get_response(ip: str, head: bytes) -> Tuple[int, bytes, str]:
+    """Build the response body for a request.
+
+    Args:
+        ip (str): Client's ip.
+        head (bytes): Request line and headers without the final CRLFs.
+
+    Returns:
+        Status code, body and its content type.
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        return 400, b"", "text/plain"
+    # HTTP proxies send the absolute URL instead of the path.
+    query = parse_qs(urlsplit(parts[1]).query, keep_blank_values=True)
+    if "headers" not in query:
+        return 200, f"{ip}\n".encode(), "text/plain"
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip()] = value.strip()
+    body = json.dumps({"ip": ip, "headers": headers}).encode()
+    return 200, body, "application/json"
+
+
+def create_ssl_context(cert: str, key: Optional[str] = None) -> ssl.SSLContext:
+    """Server-side SSL context for the https judge.
+
+    Args:
+        cert (str): Path to the PEM certificate chain.
+        key (str): Path to the PEM private key if it isn't in cert.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+async def serve(
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    ssl_context: Optional[ssl.SSLContext] = None,
+    backlog: int = 4096,
+) -> asyncio.AbstractServer:
+    """Start the judge on the running loop.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on, 0 for any free one.
+        ssl_context (SSLContext): Serve https if set.
+        backlog (int): Listen backlog, raise it for high concurrency.
+    """
+    return await asyncio.get_running_loop().create_server(
+        JudgeProtocol, host, port, ssl=ssl_context, backlog=backlog
+    )
+
+
+async def run(args: argparse.Namespace, console: Console) -> None:
+    servers = [await serve(args.host, args.port, backlog=args.backlog)]
+    console.print(f"[green]Judge: http://{args.host}:{args.port}/[/green]")
+    if args.tls_port is not None:
+        servers.append(
+            await serve(
+                args.host,
+                args.tls_port,
+                create_ssl_context(args.cert, args.key),
+                args.backlog,
+            )
+        )
+        console.print(
+            f"[green]Judge: https://{args.host}:{args.tls_port}/[/green]"
+        )
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--tls-port", type=int, help="also serve https on this port"
+    )
+    parser.add_argument("--cert", help="PEM certificate chain for https")
+    parser.add_argument("--key", help="PEM private key for https")
+    parser.add_argument("--backlog", type=int, default=4096)
+    args = parser.parse_args()
+    if args.tls_port is not None and not args.cert:
+        parser.error("--tls-port requires --cert")
+    try:
+        asyncio.run(run(args, Console()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""AIMD concurrency limiter used instead of a fixed asyncio.Semaphore."""
+import asyncio
+import errno
+from collections import deque
+from typing import Any, Deque, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+# Errors that mean this machine, not the proxy, is out of resources.
+LOCAL_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in (
+        "EMFILE",
+        "ENFILE",
+        "ENOBUFS",
+        "ENOMEM",
+        "EADDRNOTAVAIL",
+        "WSAEMFILE",
+        "WSAENOBUFS",
+        "WSAEADDRNOTAVAIL",
+    )
+    if hasattr(errno, name)
+)
+
+
+def is_local_error(error: Optional[BaseException]) -> bool:
+    """Check if the error or one of its causes is a local resource error."""
+    for _ in range(8):
+        if error is None:
+            return False
+        if isinstance(error, OSError) and error.errno in LOCAL_ERRNOS:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def raise_fd_limit() -> Optional[int]:
+    """Raise the soft RLIMIT_NOFILE up to the hard limit where allowed.
+
+    Returns:
+        int: The soft limit after raising, None if there is no limit or it
+            can't be determined (e.g. on Windows).
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    targets = [hard]
+    if hard == resource.RLIM_INFINITY:
+        # Linux doesn't allow more than fs.nr_open, macOS more than OPEN_MAX.
+        try:
+            with open("/proc/sys/fs/nr_open", encoding="utf-8") as f:
+                targets = [int(f.read())]
+        except (OSError, ValueError):
+            targets = [1048576, 10240]
+    for target in targets:
+        if soft != resource.RLIM_INFINITY and soft >= target:
+            break
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            continue
+        soft = target
+        break
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        minimum: int,
+        maximum: int,
+        *,
+        lag_threshold: float = 0.1,
+        latency_factor: float = 2,
+        backoff: float = 0.7,
+    ) -> None:
+        """Limit concurrency like asyncio.Semaphore, but adjust the limit.
+
+        The limit doubles every window until the first sign of congestion
+        and then grows additively. It is cut multiplicatively on local
+        resource errors (EMFILE, ENOBUFS, port exhaustion), event loop lag,
+        rising latency of successful checks or a falling success rate.
+        A window is one round of checks, i.e. as many as the current limit.
+
+        Args:
+            minimum (int): The limit never goes below this.
+            maximum (int): The limit never goes above this.
+            lag_threshold (float): Event loop lag in seconds that is
+                considered congestion.
+            latency_factor (float): Latency growth over the baseline that
+                is considered congestion.
+            backoff (float): The limit is multiplied by this on congestion.
+        """
+        self.MIN = max(1, min(minimum, maximum))
+        self.MAX = maximum
+        self.LAG_THRESHOLD = lag_threshold
+        self.LATENCY_FACTOR = latency_factor
+        self.BACKOFF = backoff
+        self.limit = self.MIN
+        self.peak = self.MIN
+        self.lag = 0.0
+        self._in_flight = 0
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+        self._slow_start = True
+        self._completed = 0
+        self._successes = 0
+        self._local_errors = 0
+        self._decreased = False
+        self._best_rate = 0.0
+        self._latency: Optional[float] = None
+        self._base_latency: Optional[float] = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return sum(not waiter.done() for waiter in self._waiters)
+
+    async def acquire(self) -> None:
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._wake()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *args: Any) -> None:
+        self.release()
+
+    def on_success(self, latency: float) -> None:
+        """Record a working proxy and how long its check took."""
+        self._successes += 1
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = 0.9 * self._latency + 0.1 * latency
+        self._complete()
+
+    def on_error(self, error: BaseException) -> None:
+        """Record a failed check, back off at once on local errors."""
+        if is_local_error(error):
+            self._local_errors += 1
+            if not self._decreased:
+                self._decrease()
+        self._complete()
+
+    def _complete(self) -> None:
+        self._completed += 1
+        if self._completed < max(self.limit, 50):
+            return
+        rate = self._successes / self._completed
+        congested = (
+            self._local_errors > 0
+            or self.lag > self.LAG_THRESHOLD
+            or rate < self._best_rate / 2
+        )
+        if self._latency is not None:
+            if self._base_latency is None:
+                self._base_latency = self._latency
+            elif self._latency > self._base_latency * self.LATENCY_FACTOR:
+                congested = True
+            # Let the baseline follow lasting changes of the network.
+            self._base_latency = min(self._base_latency * 1.05, self._latency)
+        self._best_rate = max(self._best_rate * 0.95, rate)
+        if congested:
+            if not self._decreased:
+                self._decrease()
+        else:
+            self._increase()
+        self._completed = self._successes = self._local_errors = 0
+        self._decreased = False
+
+    def _increase(self) -> None:
+        if self._slow_start:
+            self.limit = min(self.MAX, self.limit * 2)
+        else:
+            self.limit = min(self.MAX, self.limit + max(1, self.MAX // 50))
+        self.peak = max(self.peak, self.limit)
+        self._wake()
+
+    def _decrease(self) -> None:
+        self._slow_start = False
+        self._decreased = True
+        self.limit = max(self.MIN, int(self.limit * self.BACKOFF))
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
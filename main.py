@@ -1,27 +1,184 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
 import asyncio
+import os
+import ssl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import (
+    AbstractContextManager,
+    ExitStack,
+    asynccontextmanager,
+    nullcontext,
+)
+from hashlib import blake2b
+from heapq import heappop, heappush
 from ipaddress import IPv4Address
-from os import mkdir
-from random import shuffle
+from multiprocessing import Manager
+from queue import Empty, Queue
+from random import random, shuffle
 from shutil import rmtree
-from typing import Any, Dict, Iterable, Optional, Tuple
+from threading import Thread
+from time import monotonic, perf_counter, time, time_ns
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+    cast,
+)
+from zlib import crc32
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector
+from aiohttp.hdrs import ACCEPT, ETAG, LAST_MODIFIED, USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
 from aiohttp_socks import ProxyConnector
-from maxminddb import open_database
+from maxminddb import (
+    MODE_AUTO,
+    MODE_FILE,
+    MODE_MEMORY,
+    MODE_MMAP,
+    MODE_MMAP_EXT,
+    open_database,
+)
 from maxminddb.reader import Reader
 from rich.console import Console
 from rich.progress import (
     BarColumn,
     Progress,
+    ProgressColumn,
+    Task,
     TaskID,
     TextColumn,
     TimeRemainingColumn,
 )
 from rich.table import Table
+from rich.text import Text
 
 import config
+import raw_engine
+from geo_cache import GeolocationCache
+from history import ProxyHistory, Record
+from limiter import AdaptiveLimiter, raise_fd_limit
+from metrics import CheckerMetrics
+from metrics import serve as serve_metrics
+from profiling import PROFILE_MODES, PhaseProfiler
+from source_cache import CachedSource, SourceCache
+from store import SKIPPED, UNCHECKED, ProxyStore, find_proxies, format_proxy
+
+# Shared by all checks instead of being created for every proxy.
+SSL_CONTEXT = ssl.create_default_context()
+HEADERS = {ACCEPT: "*/*", USER_AGENT: SERVER_SOFTWARE}
+
+
+class Latency(NamedTuple):
+    """Timings of a successful check in seconds.
+
+    connect and handshake are None if the engine doesn't expose them,
+    ttfb is None for proxies carried over from history.
+    """
+
+    # TCP connect to the proxy.
+    connect: Optional[float]
+    # SOCKS or HTTP CONNECT handshake with the proxy.
+    handshake: Optional[float]
+    # From the start of the check to the first byte of the judge's response.
+    ttfb: Optional[float]
+    # The whole check, including waiting for a free connection.
+    total: float
+
+
+# Working proxies, their latencies, funnel stage counts, current and peak
+# concurrency limit and metrics (if collected) of a worker process.
+ShardResult = Tuple[
+    Dict[str, Dict[str, str]],
+    Dict[str, Dict[str, Latency]],
+    Dict[str, Dict[str, int]],
+    int,
+    int,
+    Optional[CheckerMetrics],
+]
+
+# File descriptors kept free in high concurrency mode for stdio, output
+# files, the mmdb reader and the event loop itself. One more is kept for
+# every source, because sources are fetched while checking in pipeline mode.
+FD_HEADROOM = 128
+
+# Write buffer of every output file, so a file is written in a few
+# syscalls instead of one per proxy.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# mmdb reader modes, see maxminddb.open_database.
+MMDB_MODES = {
+    # The C extension if it is installed, otherwise "mmap".
+    "auto": MODE_AUTO,
+    # The C extension with a memory-mapped file, fastest lookups.
+    "mmap_ext": MODE_MMAP_EXT,
+    # Pure Python with a memory-mapped file, fast startup.
+    "mmap": MODE_MMAP,
+    # Pure Python with the whole file read into memory.
+    "memory": MODE_MEMORY,
+    # Pure Python reading the file on every lookup, least memory.
+    "file": MODE_FILE,
+}
+# Number of exit nodes looked up in the mmdb at once while checking.
+GEOLOCATION_BATCH_SIZE = 256
+# Readers opened by get_mmdb_reader(): (path, mode) -> (mtime, reader).
+_mmdb_readers: Dict[Tuple[str, int], Tuple[float, Reader]] = {}
+
+OUTPUT_DIRS = (
+    "proxies",
+    "proxies_anonymous",
+    "proxies_geolocation",
+    "proxies_geolocation_anonymous",
+    "proxies_latency",
+)
+# Output folders are symlinks to a generation in this folder, so a new
+# generation is published at once and readers never see partial lists.
+GENERATIONS_DIR = ".proxies_generations"
+
+
+class LimitColumn(ProgressColumn):
+    """Current and peak concurrency limit of the checker tasks."""
+
+    def render(self, task: Task) -> Text:
+        return Text(task.fields.get("limit", ""), style="cyan")
+
+
+class ShardProgress:
+    """Stand-in for Progress in a worker process.
+
+    Collects progress updates and sends them to the parent process in
+    batches, the parent applies them to its own Progress.
+    """
+
+    def __init__(self, queue: "Queue[Dict[TaskID, int]]") -> None:
+        self.queue = queue
+        self.pending: Dict[TaskID, int] = {}
+        self.last_flush = monotonic()
+
+    def update(self, task: TaskID, *, advance: int = 0, **_: Any) -> None:
+        self.pending[task] = self.pending.get(task, 0) + advance
+        if monotonic() - self.last_flush > 0.2:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.queue.put(self.pending)
+            self.pending = {}
+        self.last_flush = monotonic()
 
 
 class ProxyScraperChecker:
@@ -29,28 +186,113 @@ class ProxyScraperChecker:
         self,
         *,
         max_connections: int = 950,
+        adaptive_concurrency: bool = False,
+        min_connections: int = 16,
+        high_concurrency: bool = False,
+        high_concurrency_limit: int = 50000,
         timeout: float = 5,
         geolite2_city_mmdb: Optional[str] = None,
         ip_service: str = "https://checkip.amazonaws.com",
         http_sources: Optional[Iterable[str]] = None,
         socks4_sources: Optional[Iterable[str]] = None,
         socks5_sources: Optional[Iterable[str]] = None,
+        pipeline: bool = False,
+        engine: str = "aiohttp",
+        funnel: bool = False,
+        connect_timeout: float = 2,
+        connect_connections: Optional[int] = None,
+        handshake_timeout: float = 3,
+        handshake_connections: Optional[int] = None,
+        workers: int = 1,
+        history: Optional[str] = None,
+        history_max_failures: int = 5,
+        history_reprobe: float = 0.1,
+        source_cache: Optional[str] = None,
+        incremental_ttl: Optional[float] = None,
+        sort_proxies: bool = True,
+        sort_by_latency: bool = False,
+        geolocation_cache: Optional[str] = None,
+        geolocation_mode: str = "auto",
+        metrics_port: Optional[int] = None,
+        metrics_host: str = "127.0.0.1",
+        profile: Optional[str] = None,
+        profile_output: Optional[str] = None,
         console: Optional[Console] = None,
     ) -> None:
         """Scrape and check proxies from sources and save them to files.
 
         Args:
             max_connections (int): Maximum concurrent connections.
+            adaptive_concurrency (bool): Adjust the number of concurrent
+                connections between min_connections and max_connections
+                depending on errors, latency and event loop lag.
+            min_connections (int): Lower bound for adaptive_concurrency.
+            high_concurrency (bool): Raise the open files limit as high as
+                allowed and derive max_connections (and the funnel stage
+                connections) from it instead of using the passed values.
+            high_concurrency_limit (int): Upper bound of the derived
+                max_connections.
             timeout (float): How many seconds to wait for the connection.
             geolite2_city_mmdb (str): Path to the GeoLite2-City.mmdb if you
                 want to add location info for each proxy.
             ip_service (str): Service for getting your IP address and checking
                 if proxies are valid.
+            pipeline (bool): Start checking proxies as soon as they are
+                scraped instead of waiting for all sources.
+            engine (str): "aiohttp" or "raw". "raw" does the proxy handshake
+                itself on top of asyncio sockets and uses less CPU.
+            funnel (bool): Check proxies in stages: TCP connect, then proxy
+                handshake, then the request to ip_service. Dead proxies are
+                dropped after the first cheap stage.
+            connect_timeout (float): Timeout of the TCP connect stage.
+            connect_connections (int): Concurrency of the TCP connect stage,
+                a third of max_connections by default.
+            handshake_timeout (float): Timeout of the handshake stage.
+            handshake_connections (int): Concurrency of the handshake stage,
+                a third of max_connections by default. The stages share
+                max_connections, the last one gets what these two left.
+            workers (int): Check proxies in this many processes. Every
+                process checks its own shard of proxies with its own event
+                loop and max_connections. Disables pipeline if more than 1.
+            history (str): Path to the SQLite database with results of
+                previous runs. Proxies that were alive recently are checked
+                first and chronically dead ones are skipped.
+            history_max_failures (int): Skip proxies that failed this many
+                checks in a row.
+            history_reprobe (float): Probability to check a skipped proxy
+                anyway.
+            source_cache (str): Path to the JSON file with proxy lists of
+                sources from previous runs. Sources are requested with
+                If-None-Match/If-Modified-Since and unchanged ones are not
+                parsed again.
+            incremental_ttl (float): Don't check proxies that were verified
+                alive less than this many seconds ago, carry them over from
+                history. Requires history.
+            sort_proxies (bool): Sort output files, otherwise proxies are
+                written in the order they were scraped in.
+            sort_by_latency (bool): Sort output files by time to first byte,
+                fastest first, instead of by ip:port.
+            geolocation_cache (str): Path to a JSON file to keep geolocation
+                of exit node networks in between runs. It is dropped when
+                the mmdb is updated.
+            geolocation_mode (str): How to open the mmdb: "auto",
+                "mmap_ext", "mmap", "memory" or "file", see MMDB_MODES.
+                The reader stays open for the life of the process.
+            metrics_port (int): Serve Prometheus metrics on
+                http://metrics_host:metrics_port/metrics while running.
+            metrics_host (str): Address to serve metrics on.
+            profile (str): Print wall and CPU time of every phase of main():
+                "timers", "cprofile" or "sampling" to also profile checking,
+                see profiling.py.
+            profile_output (str): Where to save the profile of checking.
         """
-        self.sem = asyncio.Semaphore(max_connections)
-        self.IP_SERVICE = ip_service.strip()
-        self.TIMEOUT = timeout
-        self.MMDB = geolite2_city_mmdb
+        if engine not in {"aiohttp", "raw"}:
+            raise ValueError(f"Unknown engine: {engine}")
+        if geolocation_mode not in MMDB_MODES:
+            raise ValueError(f"Unknown geolocation mode: {geolocation_mode}")
+        if incremental_ttl is not None and not history:
+            raise ValueError("incremental_ttl requires history")
+        self.c = console or Console()
         self.SOURCES = {
             proto: (sources,)
             if isinstance(sources, str)
@@ -62,16 +304,126 @@ class ProxyScraperChecker:
             )
             if sources
         }
-        self.proxies: Dict[str, Dict[str, Optional[str]]] = {
-            proto: {} for proto in self.SOURCES
+        if high_concurrency:
+            fd_limit = raise_fd_limit()
+            if fd_limit is None:
+                self.c.print(
+                    "[red]Can't determine the open files limit,"
+                    + " using MAX_CONNECTIONS.[/red]"
+                )
+            else:
+                headroom = FD_HEADROOM + sum(map(len, self.SOURCES.values()))
+                max_connections = max(
+                    1, min(fd_limit - headroom, high_concurrency_limit)
+                )
+                connect_connections = handshake_connections = None
+        check_connections = max_connections
+        if funnel:
+            # A connection that passed a stage stays open while it waits
+            # for the next one, so the stages split the connections instead
+            # of each having max_connections.
+            connect_connections = connect_connections or max(
+                1, max_connections // 3
+            )
+            handshake_connections = handshake_connections or max(
+                1, max_connections // 3
+            )
+            check_connections = max(
+                1,
+                max_connections - connect_connections - handshake_connections,
+            )
+        self.ADAPTIVE_CONCURRENCY = adaptive_concurrency
+        self.MIN_CONNECTIONS = min_connections
+        self.sem: Union[asyncio.Semaphore, AdaptiveLimiter] = (
+            AdaptiveLimiter(min_connections, check_connections)
+            if adaptive_concurrency
+            else asyncio.Semaphore(check_connections)
+        )
+        self.IP_SERVICE = ip_service.strip()
+        self.TIMEOUT = timeout
+        self._client_timeout = ClientTimeout(total=timeout)
+        self._session: Optional[ClientSession] = None
+        self._cookie_jar: Optional[DummyCookieJar] = None
+        self._judge: Optional[raw_engine.Judge] = None
+        self.ENGINE = engine
+        self.MMDB = geolite2_city_mmdb
+        self.GEOLOCATION_CACHE = geolocation_cache
+        self.GEOLOCATION_MODE = MMDB_MODES[geolocation_mode]
+        self.WORKERS = max(1, workers)
+        self.PIPELINE = pipeline and self.WORKERS == 1
+        self.MAX_CONNECTIONS = max_connections
+        # Connections of the last stage, all of them without FUNNEL.
+        self.CHECK_CONNECTIONS = check_connections
+        self.FUNNEL = funnel
+        self.STAGES = {
+            "connect": (connect_timeout, connect_connections or 0),
+            "handshake": (handshake_timeout, handshake_connections or 0),
         }
+        self._stage_sems = {
+            stage: asyncio.Semaphore(connections)
+            for stage, (_, connections) in self.STAGES.items()
+        }
+        self.proxies = {proto: ProxyStore() for proto in self.SOURCES}
         self.proxies_count = {proto: 0 for proto in self.SOURCES}
-        self.c = console or Console()
+        self.stage_counts = {
+            proto: dict.fromkeys(self.STAGES, 0) for proto in self.SOURCES
+        }
+        self.latencies: Dict[str, Dict[str, Latency]] = {
+            proto: {} for proto in self.SOURCES
+        }
+        self.HISTORY = history
+        self.HISTORY_MAX_FAILURES = history_max_failures
+        self.HISTORY_REPROBE = history_reprobe
+        self.history_records: Dict[str, Dict[str, Record]] = {}
+        self.skipped = {proto: 0 for proto in self.SOURCES}
+        self.INCREMENTAL_TTL = incremental_ttl
+        self.SORT_PROXIES = sort_proxies
+        self.SORT_BY_LATENCY = sort_by_latency
+        self.carried: Dict[str, Dict[str, str]] = {
+            proto: {} for proto in self.SOURCES
+        }
+        self.expired = {proto: 0 for proto in self.SOURCES}
+        self._dead: Dict[str, List[str]] = {
+            proto: [] for proto in self.SOURCES
+        }
+        self._proxy_sources: Dict[str, Dict[str, str]] = {
+            proto: {} for proto in self.SOURCES
+        }
+        self.source_cache = SourceCache(source_cache) if source_cache else None
+        # Whether self.proxies is already in the order to check it in.
+        self._ordered = False
+        # Deletes old output generations after save_proxies().
+        self.cleanup: Optional[Thread] = None
+        # Exit node -> ::Country::Region::City, filled while checking.
+        self.geolocations: Dict[str, str] = {}
+        self._geo_batch: List[str] = []
+        self._geo_queued: Set[str] = set()
+        self._geo_futures: Set["asyncio.Future[Dict[str, str]]"] = set()
+        self._geo_executor: Optional[ThreadPoolExecutor] = None
+        self._geo_cache: Optional[GeolocationCache] = None
+        self.METRICS_PORT = metrics_port
+        self.METRICS_HOST = metrics_host
+        self.metrics = CheckerMetrics() if metrics_port is not None else None
+        self.profiler = (
+            PhaseProfiler(profile, profile_output) if profile else None
+        )
 
     @staticmethod
-    def append_to_file(file_path: str, content: str) -> None:
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(f"{content}\n")
+    def get_latency(latency: Optional[Latency]) -> str:
+        """Get proxy's latency.
+
+        Args:
+            latency (Latency): Timings of the proxy's check.
+
+        Returns:
+            str: ::Connect::Handshake::TTFB in milliseconds
+        """
+        if latency is None:
+            return "::None::None::None"
+        return "".join(
+            "::None" if seconds is None else f"::{seconds * 1000:.0f}"
+            for seconds in (latency.connect, latency.handshake, latency.ttfb)
+        )
 
     @staticmethod
     def get_geolocation(ip: Optional[str], reader: Reader) -> str:
@@ -86,7 +438,11 @@ class ProxyScraperChecker:
         """
         if not ip:
             return "::None::None::None"
-        geolocation = reader.get(ip)
+        return ProxyScraperChecker.format_geolocation(reader.get(ip))
+
+    @staticmethod
+    def format_geolocation(geolocation: Any) -> str:
+        """Format an mmdb record as ::Country Name::Region::City."""
         if not isinstance(geolocation, dict):
             return "::None::None::None"
         country = geolocation.get("country")
@@ -104,6 +460,78 @@ class ProxyScraperChecker:
             city = city["names"]["en"]
         return f"::{country}::{region}::{city}"
 
+    def _get_cached_geolocation(
+        self,
+        ip: Optional[str],
+        reader: Reader,
+        geo_cache: Optional[GeolocationCache],
+    ) -> str:
+        """Same as get_geolocation(), but looked up once per network."""
+        if not ip or geo_cache is None:
+            return self.get_geolocation(ip, reader)
+        geolocation = geo_cache.get(ip)
+        if geolocation is None:
+            record, prefix_len = reader.get_with_prefix_len(ip)
+            geolocation = self.format_geolocation(record)
+            geo_cache.set(ip, prefix_len, geolocation)
+        return geolocation
+
+    def _queue_geolocation(self, ip: str) -> None:
+        """Look up the exit node in the background while checking goes on.
+
+        Exit nodes are batched, so the thread is woken up once per
+        GEOLOCATION_BATCH_SIZE proxies instead of once per proxy.
+        """
+        if ip in self._geo_queued:
+            return
+        self._geo_queued.add(ip)
+        self._geo_batch.append(ip)
+        if len(self._geo_batch) >= GEOLOCATION_BATCH_SIZE:
+            self._submit_geolocation()
+
+    def _submit_geolocation(self) -> None:
+        batch, self._geo_batch = self._geo_batch, []
+        if not batch:
+            return
+        if self._geo_executor is None:
+            # One thread, so the reader and the cache are never shared.
+            self._geo_executor = ThreadPoolExecutor(
+                1, thread_name_prefix="geolocation"
+            )
+        future = asyncio.get_running_loop().run_in_executor(
+            self._geo_executor, self._locate, batch
+        )
+        self._geo_futures.add(future)
+        future.add_done_callback(self._on_located)
+
+    def _on_located(self, future: "asyncio.Future[Dict[str, str]]") -> None:
+        self._geo_futures.discard(future)
+        if not future.cancelled() and future.exception() is None:
+            self.geolocations.update(future.result())
+
+    async def finish_geolocation(self) -> None:
+        """Wait for exit nodes queued while checking to be looked up."""
+        self._submit_geolocation()
+        if self._geo_futures:
+            await asyncio.gather(*self._geo_futures)
+        if self._geo_executor is not None:
+            self._geo_executor.shutdown()
+            self._geo_executor = None
+
+    def _locate(self, ips: Iterable[Optional[str]]) -> Dict[str, str]:
+        """Geolocation of exit nodes, runs in the geolocation thread."""
+        if self.MMDB is None:
+            raise RuntimeError("Geolocation is disabled")
+        reader = get_mmdb_reader(self.MMDB, self.GEOLOCATION_MODE)
+        if self._geo_cache is None:
+            self._geo_cache = GeolocationCache(
+                self.GEOLOCATION_CACHE, reader.metadata().build_epoch
+            )
+        return {
+            ip or "": self._get_cached_geolocation(ip, reader, self._geo_cache)
+            for ip in ips
+        }
+
     async def fetch_source(
         self,
         session: ClientSession,
@@ -111,36 +539,135 @@ class ProxyScraperChecker:
         proto: str,
         progress: Progress,
         task: TaskID,
+        enqueue: Optional[Callable[[str, str], Awaitable[None]]] = None,
+        check_task: Optional[TaskID] = None,
     ) -> None:
         """Get proxies from source.
 
         Args:
             source (str): Proxy list URL.
             proto (str): http/socks4/socks5.
+            enqueue (callable): If passed, it is called with every new
+                proxy and proto to check the proxy right away.
+            check_task (TaskID): Checker progress task, its total is
+                increased by the number of new proxies.
         """
+        cached = (
+            self.source_cache.get(proto, source) if self.source_cache else None
+        )
+        start = perf_counter()
         try:
-            async with session.get(source.strip(), timeout=15) as r:
+            async with session.get(
+                source.strip(),
+                timeout=15,
+                headers=cached.get_headers() if cached else None,
+            ) as r:
                 status = r.status
-                text = await r.text(encoding="utf-8")
+                body = await r.read()
+                etag = r.headers.get(ETAG)
+                last_modified = r.headers.get(LAST_MODIFIED)
         except Exception as e:
             self.c.print(f"{source}: {e}")
         else:
-            if status == 200:
-                for proxy in text.splitlines():
-                    proxy = (
-                        proxy.replace(f"{proto}://", "")
-                        .replace("https://", "")
-                        .strip()
+            if self.metrics is not None:
+                self.metrics.fetch_duration.set(
+                    proto, source, value=perf_counter() - start
+                )
+            if status == 304 and cached is not None:
+                await self._add_proxies(
+                    cached.proxies,
+                    source,
+                    proto,
+                    progress,
+                    enqueue,
+                    check_task,
+                )
+            elif status == 200:
+                digest = blake2b(body, digest_size=16).hexdigest()
+                if cached is not None and cached.digest == digest:
+                    proxies = cached.proxies
+                else:
+                    proxies = self.parse_proxies(body, proto)
+                if self.source_cache:
+                    self.source_cache.set(
+                        proto,
+                        source,
+                        CachedSource(etag, last_modified, digest, proxies),
                     )
-                    try:
-                        IPv4Address(proxy.split(":")[0])
-                    except Exception:
-                        continue
-                    self.proxies[proto][proxy] = None
+                await self._add_proxies(
+                    proxies, source, proto, progress, enqueue, check_task
+                )
             else:
                 self.c.print(f"{source} status code: {status}")
         progress.update(task, advance=1)
 
+    @staticmethod
+    def parse_proxies(data: bytes, proto: str) -> List[Tuple[int, int]]:
+        """Get proxies from a proxy list.
+
+        Args:
+            data (bytes): Proxy list, one proxy per line.
+            proto (str): http/socks4/socks5.
+
+        Returns:
+            (IPv4 address as an int, port) of every proxy, see find_proxies.
+        """
+        return find_proxies(data, proto)
+
+    async def _add_proxies(
+        self,
+        proxies: Sequence[Tuple[int, int]],
+        source: str,
+        proto: str,
+        progress: Progress,
+        enqueue: Optional[Callable[[str, str], Awaitable[None]]],
+        check_task: Optional[TaskID],
+    ) -> None:
+        """Add new proxies from a source and queue them for checking.
+
+        Proxies go into the store as integers, ip:port strings are only
+        made for history and the queue.
+        """
+        store = self.proxies[proto]
+        filtered = enqueue is not None and bool(self.history_records)
+        # Skipped until they pass the history filter, never added again.
+        status = SKIPPED if filtered else UNCHECKED
+        add = store.add_packed
+        new = [(ip, port) for ip, port in proxies if add(ip, port, status)]
+        if self.metrics is not None:
+            self.metrics.scraped.inc(proto, amount=len(proxies))
+            self.metrics.duplicates.inc(proto, amount=len(proxies) - len(new))
+            self.metrics.source_proxies.set(proto, source, value=len(proxies))
+        if not self.HISTORY and enqueue is None:
+            return
+        new_proxies = [format_proxy(ip, port) for ip, port in new]
+        if self.HISTORY:
+            proxy_sources = self._proxy_sources[proto]
+            for proxy in new_proxies:
+                proxy_sources[proxy] = source
+        if filtered:
+            records = self.history_records.get(proto, {})
+            new_proxies = self._filter_by_history(proto, new_proxies)
+            # Likely alive proxies of the source are queued first.
+            new_proxies.sort(
+                key=lambda proxy: self._get_history_priority(
+                    records.get(proxy)
+                )
+            )
+            for proxy in new_proxies:
+                store[proxy] = None
+        if enqueue is not None:
+            if check_task is not None:
+                progress.update(
+                    check_task,
+                    total=store.total
+                    - self.skipped[proto]
+                    - len(self.carried[proto]),
+                    visible=True,
+                )
+            for proxy in new_proxies:
+                await enqueue(proxy, proto)
+
     async def check_proxy(
         self, proxy: str, proto: str, progress: Progress, task: TaskID
     ) -> None:
@@ -150,30 +677,242 @@ class ProxyScraperChecker:
             proxy (str): ip:port.
             proto (str): http/socks4/socks5.
         """
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.in_flight.inc()
+        start = perf_counter()
         try:
-            async with self.sem:
-                async with ClientSession(
-                    connector=ProxyConnector.from_url(f"{proto}://{proxy}")
-                ) as session:
-                    async with session.get(
-                        self.IP_SERVICE, timeout=self.TIMEOUT
-                    ) as r:
-                        exit_node = await r.text(encoding="utf-8")
+            if self.FUNNEL:
+                (
+                    exit_node,
+                    latency,
+                    in_slot,
+                ) = await self._get_exit_node_funnel(proxy, proto)
+            else:
+                async with self.sem:
+                    acquired = perf_counter()
+                    exit_node, latency = await self._get_exit_node(
+                        proxy, proto
+                    )
+                    in_slot = perf_counter() - acquired
             exit_node = exit_node.strip()
             IPv4Address(exit_node)
         except Exception as e:
+            if isinstance(self.sem, AdaptiveLimiter):
+                self.sem.on_error(e)
 
             # Too many open files
-            if isinstance(e, OSError) and e.errno == 24:
+            elif isinstance(e, OSError) and e.errno == 24:
                 self.c.print(
                     "[red]Please, set MAX_CONNECTIONS to lower value.[/red]"
                 )
 
             self.proxies[proto].pop(proxy)
+            if self.HISTORY:
+                self._dead[proto].append(proxy)
+            if metrics is not None:
+                metrics.failed.inc(proto, type(e).__name__)
         else:
+            latency = latency._replace(total=perf_counter() - start)
+            if isinstance(self.sem, AdaptiveLimiter):
+                # Without the time spent waiting for the limiter itself,
+                # otherwise a long queue looks like congestion.
+                self.sem.on_success(in_slot)
             self.proxies[proto][proxy] = exit_node
+            self.latencies[proto][proxy] = latency
+            if self.MMDB:
+                self._queue_geolocation(exit_node)
+            if metrics is not None:
+                metrics.alive.inc(proto)
+                metrics.latency.observe(latency.total, proto)
+        if metrics is not None:
+            metrics.checked.inc(proto)
+            metrics.in_flight.dec()
         progress.update(task, advance=1)
 
+    async def _get_exit_node(
+        self, proxy: str, proto: str
+    ) -> Tuple[str, Latency]:
+        """Request IP_SERVICE through the proxy.
+
+        HTTP proxies are passed per request to the shared session. SOCKS
+        proxies need their own connector, but it reuses the shared SSL
+        context, timeout, headers and cookie jar. aiohttp connects and does
+        the handshake internally, so only ttfb is measured.
+
+        Returns:
+            Response body and the check's latency without the total.
+        """
+        if self.ENGINE == "raw":
+            return await self._get_exit_node_raw(proxy, proto)
+        if self._session is None or self._cookie_jar is None:
+            raise RuntimeError("Checks must run inside _check_session()")
+        start = perf_counter()
+        if proto == "http":
+            async with self._session.get(
+                self.IP_SERVICE, proxy=f"http://{proxy}"
+            ) as r:
+                ttfb = perf_counter() - start
+                text = await r.text(encoding="utf-8")
+            return text, Latency(None, None, ttfb, ttfb)
+        async with ClientSession(
+            connector=ProxyConnector.from_url(
+                f"{proto}://{proxy}", ssl=SSL_CONTEXT, force_close=True
+            ),
+            cookie_jar=self._cookie_jar,
+            headers=HEADERS,
+            timeout=self._client_timeout,
+        ) as session:
+            async with session.get(self.IP_SERVICE) as r:
+                ttfb = perf_counter() - start
+                text = await r.text(encoding="utf-8")
+        return text, Latency(None, None, ttfb, ttfb)
+
+    async def _get_exit_node_raw(
+        self, proxy: str, proto: str
+    ) -> Tuple[str, Latency]:
+        """Same as raw_engine.check(), but timing every step."""
+        judge = self._judge
+        if judge is None:
+            raise RuntimeError("Checks must run inside _check_session()")
+        host, port = proxy.rsplit(":", 1)
+
+        async def check() -> Tuple[str, Latency]:
+            start = perf_counter()
+            sock = await raw_engine.connect(host, int(port))
+            connect = perf_counter() - start
+            try:
+                await raw_engine.handshake(sock, proto, judge)
+            except BaseException:
+                sock.close()
+                raise
+            handshake = perf_counter() - start - connect
+            # The judge's response fits into a single packet.
+            text = await raw_engine.fetch(sock, judge, SSL_CONTEXT)
+            ttfb = perf_counter() - start
+            return text, Latency(connect, handshake, ttfb, ttfb)
+
+        return await asyncio.wait_for(check(), self.TIMEOUT)
+
+    async def _get_exit_node_funnel(
+        self, proxy: str, proto: str
+    ) -> Tuple[str, Latency, float]:
+        """Check the proxy stage by stage, each with its own limits.
+
+        The raw engine reuses the tunnel from the handshake stage for the
+        request, aiohttp opens a new connection. A tunnel waits for a slot
+        of the last stage for at most TIMEOUT seconds, then it is closed and
+        the proxy is checked again over a new connection, so idle tunnels
+        don't pile up and proxies that close them aren't counted as dead.
+        Every stage is timed from the moment it got its connection slot.
+
+        Returns:
+            Response body, the check's latency without the total and
+            seconds spent holding a connection of the last stage.
+        """
+        if self._judge is None:
+            raise RuntimeError("Checks must run inside _check_session()")
+        host, port = proxy.rsplit(":", 1)
+        timeout, _ = self.STAGES["connect"]
+        async with self._stage_sems["connect"]:
+            start = perf_counter()
+            sock = await asyncio.wait_for(
+                raw_engine.connect(host, int(port)), timeout
+            )
+            connect = perf_counter() - start
+        try:
+            self.stage_counts[proto]["connect"] += 1
+            timeout, _ = self.STAGES["handshake"]
+            async with self._stage_sems["handshake"]:
+                start = perf_counter()
+                await asyncio.wait_for(
+                    raw_engine.handshake(sock, proto, self._judge), timeout
+                )
+                handshake = perf_counter() - start
+            self.stage_counts[proto]["handshake"] += 1
+            if self.ENGINE == "raw":
+                try:
+                    await asyncio.wait_for(self.sem.acquire(), self.TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Checked again below over a new connection.
+                    pass
+                else:
+                    try:
+                        start = perf_counter()
+                        tunnel, sock = sock, None
+                        text = await asyncio.wait_for(
+                            raw_engine.fetch(tunnel, self._judge, SSL_CONTEXT),
+                            self.TIMEOUT,
+                        )
+                        fetch = perf_counter() - start
+                    finally:
+                        self.sem.release()
+                    ttfb = connect + handshake + fetch
+                    return text, Latency(connect, handshake, ttfb, ttfb), fetch
+        finally:
+            if sock is not None:
+                sock.close()
+        async with self.sem:
+            start = perf_counter()
+            text, latency = await self._get_exit_node(proxy, proto)
+            in_slot = perf_counter() - start
+        # A new connection, its ttfb is that of a fresh connection.
+        return (
+            text,
+            latency._replace(connect=connect, handshake=handshake),
+            in_slot,
+        )
+
+    async def _monitor_concurrency(
+        self, progress: Progress, tasks: Dict[str, TaskID]
+    ) -> None:
+        """Feed event loop lag to the limiter and show its limit."""
+        if not isinstance(self.sem, AdaptiveLimiter):
+            return
+        loop = asyncio.get_running_loop()
+        interval = 0.1
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.sem.lag = max(0.0, loop.time() - start - interval)
+            limit = f"[{self.sem.limit}/{self.sem.peak}]"
+            for task in tasks.values():
+                progress.update(task, limit=limit)
+
+    def _check_concurrency(self) -> int:
+        """Number of checks that may be in flight at the same time."""
+        if self.FUNNEL:
+            return self.CHECK_CONNECTIONS + sum(
+                connections for _, connections in self.STAGES.values()
+            )
+        return self.CHECK_CONNECTIONS
+
+    @asynccontextmanager
+    async def _check_session(self) -> AsyncIterator[None]:
+        """Open the session shared by checks for the duration of a run."""
+        if self.FUNNEL or self.ENGINE == "raw":
+            self._judge = await raw_engine.resolve_judge(self.IP_SERVICE)
+        if self.ENGINE == "raw":
+            try:
+                yield
+            finally:
+                self._judge = None
+            return
+        self._cookie_jar = DummyCookieJar()
+        async with ClientSession(
+            connector=TCPConnector(ssl=SSL_CONTEXT, limit=0, force_close=True),
+            cookie_jar=self._cookie_jar,
+            headers=HEADERS,
+            timeout=self._client_timeout,
+        ) as session:
+            self._session = session
+            try:
+                yield
+            finally:
+                self._session = None
+                self._cookie_jar = None
+                self._judge = None
+
     async def fetch_all_sources(self) -> None:
         """Get proxies from sources."""
         with self._get_progress() as progress:
@@ -194,10 +933,246 @@ class ProxyScraperChecker:
                     for source in sources
                 )
                 await asyncio.gather(*coroutines)
+        if self.source_cache:
+            self.source_cache.save()
         for proto, proxies in self.proxies.items():
             self.proxies_count[proto] = len(proxies)
 
+    async def scrape_and_check(self) -> None:
+        """Get proxies from sources and check them at the same time.
+
+        Every new proxy is put into a bounded queue as soon as its source is
+        parsed, so the checkers don't wait for the slowest source. Checkers
+        are started as proxies arrive, never more than were queued.
+        """
+        concurrency = self._check_concurrency()
+        queue: "asyncio.Queue[Optional[Tuple[str, str]]]" = asyncio.Queue(
+            concurrency
+        )
+        workers: "List[asyncio.Future[None]]" = []
+        with self._get_progress() as progress:
+            scrape_tasks = {
+                proto: progress.add_task(
+                    "[yellow]Scraper[/yellow] [red]::[/red]"
+                    + f" [green]{proto.upper()}[/green]",
+                    total=len(sources),
+                )
+                for proto, sources in self.SOURCES.items()
+            }
+            check_tasks = {
+                proto: progress.add_task(
+                    "[yellow]Checker[/yellow] [red]::[/red]"
+                    + f" [green]{proto.upper()}[/green]",
+                    total=0,
+                    visible=False,
+                )
+                for proto in self.SOURCES
+            }
+
+            async def enqueue(proxy: str, proto: str) -> None:
+                if len(workers) < concurrency:
+                    workers.append(
+                        asyncio.ensure_future(
+                            self._check_queue_worker(
+                                queue, progress, check_tasks
+                            )
+                        )
+                    )
+                await queue.put((proxy, proto))
+
+            monitor = asyncio.ensure_future(
+                self._monitor_concurrency(progress, check_tasks)
+            )
+            try:
+                async with ClientSession() as session, self._check_session():
+                    coroutines = (
+                        self.fetch_source(
+                            session,
+                            source,
+                            proto,
+                            progress,
+                            scrape_tasks[proto],
+                            enqueue,
+                            check_tasks[proto],
+                        )
+                        for proto, sources in self.SOURCES.items()
+                        for source in sources
+                    )
+                    await asyncio.gather(*coroutines)
+                    if self.source_cache:
+                        self.source_cache.save()
+                    for _ in workers:
+                        await queue.put(None)
+                    await asyncio.gather(*workers)
+            finally:
+                # Workers are still waiting for proxies if scraping failed.
+                for future in (monitor, *workers):
+                    future.cancel()
+        for proto, proxies in self.proxies.items():
+            self.proxies_count[proto] = proxies.total
+
+    async def _check_queue_worker(
+        self,
+        queue: "asyncio.Queue[Optional[Tuple[str, str]]]",
+        progress: Progress,
+        tasks: Dict[str, TaskID],
+    ) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            proxy, proto = item
+            await self.check_proxy(proxy, proto, progress, tasks[proto])
+
+    async def _check_worker(
+        self,
+        proxies: Iterator[Tuple[str, str]],
+        progress: Progress,
+        tasks: Dict[str, TaskID],
+    ) -> None:
+        for proxy, proto in proxies:
+            await self.check_proxy(proxy, proto, progress, tasks[proto])
+
+    def _iter_proxies(self) -> Iterator[Tuple[str, str]]:
+        """Yield (proxy, proto) pairs in random order.
+
+        Proxies of each protocol are shuffled separately (unless they are
+        already ordered by history) and the protocols are interleaved in
+        proportion to their size, so no coroutine or tuple is created per
+        proxy in advance.
+        """
+        pools: List[Tuple[str, ProxyStore, Sequence[int]]] = []
+        for proto, proxies in self.proxies.items():
+            if proxies:
+                rows = proxies.live_rows()
+                if not self._ordered:
+                    shuffle(rows)
+                pools.append((proto, proxies, rows))
+        positions = [0] * len(pools)
+        heap = [(0.0, i) for i in range(len(pools))]
+        while heap:
+            _, i = heappop(heap)
+            proto, proxies, rows = pools[i]
+            position = positions[i]
+            yield proxies.key_at(rows[position]), proto
+            position += 1
+            positions[i] = position
+            if position < len(rows):
+                heappush(heap, (position / len(rows), i))
+
+    def _should_skip(self, record: Optional[Record]) -> bool:
+        """Whether to skip a chronically dead proxy this time."""
+        return (
+            record is not None
+            and record.failures >= self.HISTORY_MAX_FAILURES
+            and random() >= self.HISTORY_REPROBE
+        )
+
+    @staticmethod
+    def _get_history_priority(record: Optional[Record]) -> Tuple[int, float]:
+        """Sorting key, likely alive proxies first."""
+        if record is None:
+            return (2, 0)
+        if record.last_alive is None:
+            return (3, record.failures)
+        if record.failures:
+            return (1, record.failures)
+        return (0, -record.last_alive)
+
+    def _filter_by_history(
+        self, proto: str, proxies: Iterable[str]
+    ) -> List[str]:
+        """Drop skipped and carried over proxies, return the ones to check.
+
+        Proxies verified alive within INCREMENTAL_TTL go to self.carried
+        with their exit node and latency from history.
+        """
+        records = self.history_records.get(proto, {})
+        carried = self.carried[proto]
+        latencies = self.latencies[proto]
+        now = time()
+        checked = []
+        for proxy in proxies:
+            record = records.get(proxy)
+            if (
+                self.INCREMENTAL_TTL is not None
+                and record is not None
+                and record.last_alive is not None
+                and not record.failures
+            ):
+                if now - record.last_alive <= self.INCREMENTAL_TTL:
+                    carried[proxy] = record.exit_node or ""
+                    latencies[proxy] = Latency(
+                        record.connect,
+                        record.handshake,
+                        record.latency,
+                        record.latency or 0.0,
+                    )
+                    continue
+                self.expired[proto] += 1
+            if self._should_skip(record):
+                self.skipped[proto] += 1
+                continue
+            checked.append(proxy)
+        return checked
+
+    def _prioritize(self) -> None:
+        """Order proxies by history, drop skipped and carried over ones."""
+        for proto, proxies in self.proxies.items():
+            records = self.history_records.get(proto, {})
+            keys = list(proxies)
+            shuffle(keys)
+            checked = self._filter_by_history(proto, keys)
+            checked.sort(
+                key=lambda proxy: self._get_history_priority(
+                    records.get(proxy)
+                )
+            )
+            self.proxies[proto] = ProxyStore(checked)
+        self._ordered = True
+
+    def load_history(self) -> None:
+        if not self.HISTORY:
+            return
+        history = ProxyHistory(self.HISTORY)
+        try:
+            self.history_records = {
+                proto: history.load(proto) for proto in self.SOURCES
+            }
+        finally:
+            history.close()
+
+    def save_history(self) -> None:
+        if not self.HISTORY:
+            return
+        history = ProxyHistory(self.HISTORY)
+        try:
+            for proto, proxies in self.proxies.items():
+                latencies = self.latencies[proto]
+                carried = self.carried[proto]
+                history.record(
+                    proto,
+                    {
+                        proxy: (
+                            exit_node or "",
+                            (
+                                latencies[proxy].connect,
+                                latencies[proxy].handshake,
+                                latencies[proxy].ttfb,
+                            ),
+                        )
+                        for proxy, exit_node in proxies.items()
+                        if proxy not in carried
+                    },
+                    self._dead[proto],
+                    self._proxy_sources[proto],
+                )
+        finally:
+            history.close()
+
     async def check_all_proxies(self) -> None:
+        if self.history_records:
+            self._prioritize()
         with self._get_progress() as progress:
             tasks = {
                 proto: progress.add_task(
@@ -207,91 +1182,434 @@ class ProxyScraperChecker:
                 )
                 for proto, proxies in self.proxies.items()
             }
-            coroutines = [
-                self.check_proxy(proxy, proto, progress, tasks[proto])
-                for proto, proxies in self.proxies.items()
-                for proxy in proxies
-            ]
-            shuffle(coroutines)
-            await asyncio.gather(*coroutines)
+            if self.WORKERS > 1:
+                await self._check_sharded(progress, tasks)
+            else:
+                await self._check_proxies(progress, tasks)
 
-    def sort_proxies(self) -> None:
+    async def _check_proxies(
+        self, progress: Progress, tasks: Dict[str, TaskID]
+    ) -> None:
+        total = sum(map(len, self.proxies.values()))
+        proxies = self._iter_proxies()
+        monitor = asyncio.ensure_future(
+            self._monitor_concurrency(progress, tasks)
+        )
+        try:
+            async with self._check_session():
+                await asyncio.gather(
+                    *(
+                        self._check_worker(proxies, progress, tasks)
+                        for _ in range(min(self._check_concurrency(), total))
+                    )
+                )
+        finally:
+            monitor.cancel()
+
+    async def _check_sharded(
+        self, progress: Progress, tasks: Dict[str, TaskID]
+    ) -> None:
+        """Check proxies in WORKERS processes and merge the results.
+
+        Proxies are split into shards by a hash of ip:port, every process
+        runs its own event loop with its own concurrency budget.
+        """
+        shards: List[Dict[str, List[str]]] = [
+            {proto: [] for proto in self.proxies} for _ in range(self.WORKERS)
+        ]
+        for proto, proxies in self.proxies.items():
+            for proxy in proxies:
+                shards[crc32(proxy.encode()) % self.WORKERS][proto].append(
+                    proxy
+                )
+        options = self._get_shard_options()
+        uvloop = type(asyncio.get_event_loop_policy()).__module__.startswith(
+            "uvloop"
+        )
+        loop = asyncio.get_running_loop()
+        with Manager() as manager, ProcessPoolExecutor(
+            self.WORKERS
+        ) as executor:
+            queue = manager.Queue()
+            results = asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        executor,
+                        check_shard,
+                        options,
+                        shard,
+                        tasks,
+                        queue,
+                        self._ordered,
+                        uvloop,
+                        self.metrics is not None,
+                    )
+                    for shard in shards
+                )
+            )
+            while not results.done():
+                await asyncio.wait({results}, timeout=0.1)
+                self._apply_shard_progress(progress, queue)
+            self._apply_shard_progress(progress, queue)
+            shard_results = results.result()
+        for proxies in self.proxies.values():
+            proxies.clear()
+        limit = peak = 0
+        for shard, (
+            shard_proxies,
+            latencies,
+            stage_counts,
+            shard_limit,
+            shard_peak,
+            shard_metrics,
+        ) in zip(shards, shard_results):
+            for proto, proxies in shard_proxies.items():
+                self.proxies[proto].update(proxies)
+                self.latencies[proto].update(latencies[proto])
+                for stage, count in stage_counts[proto].items():
+                    self.stage_counts[proto][stage] += count
+                if self.HISTORY:
+                    self._dead[proto].extend(
+                        proxy for proxy in shard[proto] if proxy not in proxies
+                    )
+            limit += shard_limit
+            peak += shard_peak
+            if self.metrics is not None and shard_metrics is not None:
+                self.metrics.merge(shard_metrics)
+        if isinstance(self.sem, AdaptiveLimiter):
+            self.sem.limit, self.sem.peak = limit, peak
+
+    @staticmethod
+    def _apply_shard_progress(
+        progress: Progress, queue: "Queue[Dict[TaskID, int]]"
+    ) -> None:
+        while True:
+            try:
+                updates = queue.get_nowait()
+            except Empty:
+                return
+            for task, advance in updates.items():
+                progress.update(task, advance=advance)
+
+    def _get_shard_options(self) -> Dict[str, Any]:
+        """Constructor arguments for the checkers in worker processes."""
+        (connect_timeout, connect_connections) = self.STAGES["connect"]
+        (handshake_timeout, handshake_connections) = self.STAGES["handshake"]
+        return {
+            "max_connections": self.MAX_CONNECTIONS,
+            "adaptive_concurrency": self.ADAPTIVE_CONCURRENCY,
+            "min_connections": self.MIN_CONNECTIONS,
+            "timeout": self.TIMEOUT,
+            "ip_service": self.IP_SERVICE,
+            "engine": self.ENGINE,
+            "funnel": self.FUNNEL,
+            "connect_timeout": connect_timeout,
+            "connect_connections": connect_connections,
+            "handshake_timeout": handshake_timeout,
+            "handshake_connections": handshake_connections,
+        }
+
+    async def check_shard(
+        self,
+        proxies: Dict[str, List[str]],
+        tasks: Dict[str, TaskID],
+        queue: "Queue[Dict[TaskID, int]]",
+        ordered: bool = False,
+    ) -> ShardResult:
+        """Check a shard of proxies in a worker process."""
         self.proxies = {
-            proto: dict(sorted(proxies.items(), key=self._get_sorting_key))
+            proto: ProxyStore(proxies) for proto, proxies in proxies.items()
+        }
+        self.latencies = {proto: {} for proto in proxies}
+        self.stage_counts = {
+            proto: dict.fromkeys(self.STAGES, 0) for proto in proxies
+        }
+        self._ordered = ordered
+        progress = ShardProgress(queue)
+        await self._check_proxies(cast(Progress, progress), tasks)
+        progress.flush()
+        if isinstance(self.sem, AdaptiveLimiter):
+            limit, peak = self.sem.limit, self.sem.peak
+        else:
+            limit = peak = self.CHECK_CONNECTIONS
+        working = {
+            proto: cast(Dict[str, str], dict(proxies))
             for proto, proxies in self.proxies.items()
         }
+        return (
+            working,
+            self.latencies,
+            self.stage_counts,
+            limit,
+            peak,
+            self.metrics,
+        )
+
+    def sort_proxies(self) -> None:
+        if not self.SORT_PROXIES:
+            return
+        if not self.SORT_BY_LATENCY:
+            self.proxies = {
+                proto: proxies.sorted()
+                for proto, proxies in self.proxies.items()
+            }
+            return
+        for proto, proxies in self.proxies.items():
+            latencies = self.latencies[proto]
+            self.proxies[proto] = ProxyStore.from_items(
+                sorted(
+                    proxies.items(),
+                    key=lambda x: self._get_latency_sorting_key(
+                        latencies.get(x[0])
+                    ),
+                )
+            )
 
     def save_proxies(self) -> None:
-        """Delete old proxies and save new ones."""
-        dirs_to_delete = (
-            "proxies",
-            "proxies_anonymous",
-            "proxies_geolocation",
-            "proxies_geolocation_anonymous",
-        )
-        for dir in dirs_to_delete:
-            try:
-                rmtree(dir)
-            except FileNotFoundError:
-                pass
+        """Save new proxies and replace the old ones at once.
+
+        Proxies are written to a new generation in GENERATIONS_DIR, then
+        every output folder is switched to it. Old generations are deleted
+        in the background.
+        """
+        generation = os.path.join(GENERATIONS_DIR, str(time_ns()))
         dirs_to_create = (
-            dirs_to_delete if self.MMDB else ("proxies", "proxies_anonymous")
+            OUTPUT_DIRS
+            if self.MMDB
+            else ("proxies", "proxies_anonymous", "proxies_latency")
         )
         for dir in dirs_to_create:
-            mkdir(dir)
+            os.makedirs(os.path.join(generation, dir))
 
-        # proxies and proxies_anonymous folders
+        if self.MMDB:
+            with self._phase("geolocate"):
+                # Exit nodes that weren't looked up while checking, e.g.
+                # carried over from history or checked in worker processes.
+                self.geolocations.update(
+                    self._locate(
+                        {
+                            exit_node
+                            for proxies in self.proxies.values()
+                            for exit_node in proxies.values()
+                            if (exit_node or "") not in self.geolocations
+                        }
+                    )
+                )
+                if self._geo_cache is not None:
+                    self._geo_cache.save()
         for proto, proxies in self.proxies.items():
-            path = f"proxies/{proto}.txt"
-            path_anonymous = f"proxies_anonymous/{proto}.txt"
-            for proxy, exit_node in proxies.items():
-                self.append_to_file(path, proxy)
-                if exit_node != proxy.split(":")[0]:
-                    self.append_to_file(path_anonymous, proxy)
+            self._write_proxies(generation, proto, proxies)
 
-        # proxies_geolocation and proxies_geolocation_anonymous folders
-        if self.MMDB:
-            with open_database(self.MMDB) as reader:
-                for proto, proxies in self.proxies.items():
-                    path = f"proxies_geolocation/{proto}.txt"
-                    path_anonymous = (
-                        f"proxies_geolocation_anonymous/{proto}.txt"
+        for dir in OUTPUT_DIRS:
+            self._publish(dir, generation if dir in dirs_to_create else None)
+        self.cleanup = Thread(
+            target=self._delete_old_generations,
+            args=(os.path.abspath(generation),),
+            name="delete-old-generations",
+        )
+        self.cleanup.start()
+
+    @staticmethod
+    def _publish(dir: str, generation: Optional[str]) -> None:
+        """Point the output folder to the generation, remove it if None."""
+        if os.path.isdir(dir) and not os.path.islink(dir):
+            # A real folder, e.g. from an older version. Move it away to be
+            # deleted with old generations.
+            os.rename(dir, os.path.join(GENERATIONS_DIR, f"{time_ns()}-{dir}"))
+        if generation is None:
+            if os.path.lexists(dir):
+                os.remove(dir)
+            return
+        target = os.path.join(generation, dir)
+        tmp = f"{dir}.tmp"
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(target, tmp, target_is_directory=True)
+        except (OSError, NotImplementedError):
+            # No symlinks, e.g. on Windows without the privilege. The folder
+            # is missing for a moment, but is never partially written.
+            if os.path.lexists(dir):
+                os.remove(dir)
+            os.rename(target, dir)
+            return
+        os.replace(tmp, dir)
+
+    @staticmethod
+    def _delete_old_generations(current: str) -> None:
+        root = os.path.dirname(current)
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if path != current:
+                rmtree(path, ignore_errors=True)
+
+    def _write_proxies(
+        self,
+        generation: str,
+        proto: str,
+        proxies: Mapping[str, Optional[str]],
+    ) -> None:
+        """Write every output folder's file of the protocol in one pass.
+
+        Args:
+            generation (str): Folder to create output folders in.
+            proto (str): http/socks4/socks5.
+            proxies (dict): ip:port -> exit node of working proxies.
+        """
+        latencies = self.latencies[proto]
+        with ExitStack() as stack:
+
+            def open_output(dir: str) -> TextIO:
+                return stack.enter_context(
+                    open(
+                        os.path.join(generation, dir, f"{proto}.txt"),
+                        "w",
+                        encoding="utf-8",
+                        buffering=OUTPUT_BUFFER_SIZE,
                     )
-                    for proxy, exit_node in proxies.items():
-                        line = proxy + self.get_geolocation(exit_node, reader)
-                        self.append_to_file(path, line)
-                        if exit_node != proxy.split(":")[0]:
-                            self.append_to_file(path_anonymous, line)
+                )
+
+            plain = open_output("proxies")
+            anonymous = open_output("proxies_anonymous")
+            latency = open_output("proxies_latency")
+            if self.MMDB:
+                geolocation = open_output("proxies_geolocation")
+                geolocation_anonymous = open_output(
+                    "proxies_geolocation_anonymous"
+                )
+            for proxy, exit_node in proxies.items():
+                line = f"{proxy}\n"
+                is_anonymous = exit_node != proxy.partition(":")[0]
+                plain.write(line)
+                if is_anonymous:
+                    anonymous.write(line)
+                latency.write(
+                    f"{proxy}{self.get_latency(latencies.get(proxy))}\n"
+                )
+                if self.MMDB:
+                    location = self.geolocations[exit_node or ""]
+                    line = f"{proxy}{location}\n"
+                    geolocation.write(line)
+                    if is_anonymous:
+                        geolocation_anonymous.write(line)
 
     async def main(self) -> None:
-        await self.fetch_all_sources()
-        await self.check_all_proxies()
+        if self.MMDB:
+            with self._phase("geolocate"):
+                # Fails here, before scraping, if the mmdb can't be opened
+                # in GEOLOCATION_MODE, e.g. mmap_ext without the extension.
+                get_mmdb_reader(self.MMDB, self.GEOLOCATION_MODE)
+        if self.metrics is None or self.METRICS_PORT is None:
+            await self._run()
+            return
+        server = await serve_metrics(
+            self._render_metrics, self.METRICS_HOST, self.METRICS_PORT
+        )
+        self.c.print(
+            f"[green]Metrics: http://{self.METRICS_HOST}:{self.METRICS_PORT}"
+            + "/metrics[/green]"
+        )
+        try:
+            await self._run()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def _run(self) -> None:
+        with self._phase("history"):
+            self.load_history()
+        if self.PIPELINE:
+            with self._phase("fetch+check", profile=True):
+                await self.scrape_and_check()
+        else:
+            with self._phase("fetch"):
+                await self.fetch_all_sources()
+            with self._phase("check", profile=True):
+                await self.check_all_proxies()
+        with self._phase("history"):
+            self.save_history()
+        for proto, carried in self.carried.items():
+            self.proxies[proto].update(carried)
+        with self._phase("geolocate"):
+            await self.finish_geolocation()
 
         table = Table()
         table.add_column("Protocol", style="cyan")
         table.add_column("Working", style="magenta")
+        if self.FUNNEL:
+            table.add_column("Connected", style="yellow")
+            table.add_column("Handshake", style="yellow")
+        if self.HISTORY:
+            table.add_column("Skipped", style="yellow")
+        if self.INCREMENTAL_TTL is not None:
+            table.add_column("Carried over", style="yellow")
+            table.add_column("Verified", style="yellow")
+            table.add_column("Expired", style="yellow")
         table.add_column("Total", style="green")
         for proto, proxies in self.proxies.items():
             working = len(proxies)
             total = self.proxies_count[proto]
             percentage = working / total * 100
+            stages = (
+                [str(count) for count in self.stage_counts[proto].values()]
+                if self.FUNNEL
+                else []
+            )
+            if self.HISTORY:
+                stages.append(str(self.skipped[proto]))
+            if self.INCREMENTAL_TTL is not None:
+                carried = len(self.carried[proto])
+                stages += (
+                    str(carried),
+                    str(working - carried),
+                    str(self.expired[proto]),
+                )
             table.add_row(
-                proto.upper(), f"{working} ({percentage:.1f}%)", str(total)
+                proto.upper(),
+                f"{working} ({percentage:.1f}%)",
+                *stages,
+                str(total),
+            )
+        if isinstance(self.sem, AdaptiveLimiter):
+            table.caption = (
+                f"Concurrency limit: {self.sem.limit} (peak {self.sem.peak})"
             )
         self.c.print(table)
 
-        self.sort_proxies()
-        self.save_proxies()
+        with self._phase("sort"):
+            self.sort_proxies()
+        with self._phase("save"):
+            self.save_proxies()
 
         self.c.print(
             "[green]Proxy folders have been created in the current directory."
             + "\nThank you for using proxy-scraper-checker :)[/green]"
         )
+        if self.profiler is not None:
+            self.profiler.report(self.c)
+
+    def _phase(
+        self, name: str, profile: bool = False
+    ) -> "AbstractContextManager[None]":
+        """Measure a phase of main() if profiling is enabled."""
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, profile)
+
+    def _render_metrics(self) -> str:
+        if self.metrics is None:
+            raise RuntimeError("Metrics are disabled")
+        self.metrics.waiters.set("check", value=count_waiters(self.sem))
+        if self.FUNNEL:
+            for stage, sem in self._stage_sems.items():
+                self.metrics.waiters.set(stage, value=count_waiters(sem))
+        return self.metrics.render()
 
     @staticmethod
-    def _get_sorting_key(x: Tuple[str, Any]) -> Tuple[int, ...]:
-        octets = x[0].replace(":", ".").split(".")
-        return tuple(map(int, octets))
+    def _get_latency_sorting_key(latency: Optional[Latency]) -> float:
+        if latency is None:
+            return float("inf")
+        return latency.total if latency.ttfb is None else latency.ttfb
 
     def _get_progress(self) -> Progress:
         return Progress(
@@ -299,14 +1617,129 @@ class ProxyScraperChecker:
             BarColumn(),
             TextColumn("[progress.percentage]{task.percentage:3.0f}%"),
             TextColumn("[blue][{task.completed}/{task.total}][/blue]"),
+            LimitColumn(),
             TimeRemainingColumn(),
             console=self.c,
         )
 
 
-async def main() -> None:
+def check_shard(
+    options: Dict[str, Any],
+    proxies: Dict[str, List[str]],
+    tasks: Dict[str, TaskID],
+    queue: "Queue[Dict[TaskID, int]]",
+    ordered: bool = False,
+    uvloop: bool = False,
+    metrics: bool = False,
+) -> ShardResult:
+    """Entry point of worker processes, see ProxyScraperChecker.check_shard.
+
+    With metrics, the shard collects them to be merged by the main process,
+    which serves them.
+    """
+    if uvloop:
+        install_uvloop()
+
+    async def run() -> ShardResult:
+        checker = ProxyScraperChecker(**options)
+        if metrics:
+            checker.metrics = CheckerMetrics()
+        return await checker.check_shard(proxies, tasks, queue, ordered)
+
+    return asyncio.run(run())
+
+
+def count_waiters(sem: Union[asyncio.Semaphore, AdaptiveLimiter]) -> int:
+    """Number of coroutines waiting to acquire the semaphore."""
+    if isinstance(sem, AdaptiveLimiter):
+        return sem.waiting
+    # asyncio.Semaphore has no public API for it.
+    waiters = getattr(sem, "_waiters", None) or ()
+    return sum(not waiter.done() for waiter in waiters)
+
+
+def get_mmdb_reader(path: str, mode: int = MODE_AUTO) -> Reader:
+    """Open the mmdb once per process and reuse the reader.
+
+    The reader is reopened if the file was modified since.
+
+    Args:
+        path (str): Path to the mmdb.
+        mode (int): One of MMDB_MODES.
+    """
+    mtime = os.stat(path).st_mtime
+    key = (os.path.abspath(path), mode)
+    cached = _mmdb_readers.get(key)
+    if cached is not None:
+        if cached[0] == mtime:
+            return cached[1]
+        cached[1].close()
+    reader = open_database(path, mode)
+    _mmdb_readers[key] = (mtime, reader)
+    return reader
+
+
+def install_uvloop() -> bool:
+    """Use uvloop for new event loops if it is installed.
+
+    Returns:
+        bool: Whether uvloop was installed.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Scrape and check proxies, settings are in config.py."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.WORKERS,
+        metavar="N",
+        help="check proxies in N processes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--uvloop",
+        action="store_true",
+        default=config.UVLOOP,
+        help="use uvloop if it is installed",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="timers",
+        choices=PROFILE_MODES,
+        metavar="MODE",
+        help="print wall and CPU time of every phase; with cprofile or"
+        + " sampling also profile checking, see profiling.py",
+    )
+    parser.add_argument(
+        "--profile-output",
+        metavar="PATH",
+        help="where to save the profile (default: profile.pstats for"
+        + " cprofile, profile.collapsed for sampling)",
+    )
+    parser.add_argument(
+        "--bench-loop",
+        action="store_true",
+        help="compare event loops on a synthetic check workload and exit",
+    )
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
     await ProxyScraperChecker(
         max_connections=config.MAX_CONNECTIONS,
+        adaptive_concurrency=config.ADAPTIVE_CONCURRENCY,
+        min_connections=config.MIN_CONNECTIONS,
+        high_concurrency=config.HIGH_CONCURRENCY,
+        high_concurrency_limit=config.HIGH_CONCURRENCY_LIMIT,
         timeout=config.TIMEOUT,
         geolite2_city_mmdb="GeoLite2-City.mmdb"
         if config.GEOLOCATION
@@ -315,8 +1748,39 @@ async def main() -> None:
         http_sources=config.HTTP_SOURCES if config.HTTP else None,
         socks4_sources=config.SOCKS4_SOURCES if config.SOCKS4 else None,
         socks5_sources=config.SOCKS5_SOURCES if config.SOCKS5 else None,
+        pipeline=config.PIPELINE,
+        engine=config.ENGINE,
+        funnel=config.FUNNEL,
+        connect_timeout=config.CONNECT_TIMEOUT,
+        connect_connections=config.CONNECT_CONNECTIONS,
+        handshake_timeout=config.HANDSHAKE_TIMEOUT,
+        handshake_connections=config.HANDSHAKE_CONNECTIONS,
+        workers=args.workers,
+        history=config.HISTORY,
+        history_max_failures=config.HISTORY_MAX_FAILURES,
+        history_reprobe=config.HISTORY_REPROBE,
+        source_cache=config.SOURCE_CACHE,
+        incremental_ttl=config.INCREMENTAL_TTL,
+        sort_proxies=config.SORT_PROXIES,
+        sort_by_latency=config.SORT_BY_LATENCY,
+        geolocation_cache=config.GEOLOCATION_CACHE,
+        geolocation_mode=config.GEOLOCATION_MODE,
+        metrics_port=config.METRICS_PORT,
+        metrics_host=config.METRICS_HOST,
+        profile=args.profile,
+        profile_output=args.profile_output,
     ).main()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.bench_loop:
+        from bench import bench_loops
+
+        bench_loops()
+    else:
+        if args.uvloop and not install_uvloop():
+            Console().print(
+                "[yellow]uvloop is not installed, using asyncio.[/yellow]"
+            )
+        asyncio.run(main(args))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Checker metrics in the Prometheus text format, without dependencies.
+
+Metrics are plain dicts updated in place, so counting a check costs a few
+dict operations. Gauges that are cheap to read, e.g. connection waiters,
+are set right before rendering instead of on every change.
+"""
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+PREFIX = "proxy_scraper_checker_"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, a check can't take much longer than TIMEOUT.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Requests with larger headers are rejected.
+MAX_REQUEST_SIZE = 8192
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Labels, values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    TYPE = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Labels = ()
+    ) -> None:
+        """Monotonic value for every combination of label values.
+
+        Args:
+            name (str): Metric name without PREFIX.
+            documentation (str): HELP text.
+            labelnames (tuple): Names of labels, values are passed to inc()
+                in the same order.
+        """
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def merge(self, other: "Counter") -> None:
+        for labels, value in other.values.items():
+            self.inc(*labels, amount=value)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        for labels, value in self.values.items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def merge(self, other: "Counter") -> None:
+        """Gauges of other processes are momentary, they aren't added."""
+
+
+class Histogram:
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        """Distribution of observed values in cumulative buckets.
+
+        Args:
+            buckets (tuple): Sorted upper bounds, +Inf is added.
+        """
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = (*buckets, float("inf"))
+        # Labels -> [count of every bucket (not cumulative), sum]
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * len(self.buckets), [0.0])
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def merge(self, other: "Histogram") -> None:
+        for labels, (counts, total) in other.values.items():
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = (
+                    [0] * len(self.buckets),
+                    [0.0],
+                )
+            for i, count in enumerate(counts):
+                entry[0][i] += count
+            entry[1][0] += total[0]
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        names = (*self.labelnames, "le")
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    names,
+                    (*labels, _format_value(bound)),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", self.labelnames, labels, total[0]
+            yield f"{self.name}_count", self.labelnames, labels, cumulative
+
+
+class CheckerMetrics:
+    def __init__(self) -> None:
+        """Everything ProxyScraperChecker counts.
+
+        Picklable, so worker processes can send theirs to the main one.
+        """
+        self.scraped = Counter(
+            "scraped_proxies_total",
+            "Proxies found in sources, including duplicates.",
+            ("proto",),
+        )
+        self.duplicates = Counter(
+            "duplicate_proxies_total",
+            "Scraped proxies dropped as already seen.",
+            ("proto",),
+        )
+        self.checked = Counter(
+            "checked_proxies_total", "Finished checks.", ("proto",)
+        )
+        self.alive = Counter(
+            "alive_proxies_total", "Checks that passed.", ("proto",)
+        )
+        self.failed = Counter(
+            "failed_proxies_total",
+            "Checks that failed, by exception class.",
+            ("proto", "error"),
+        )
+        self.latency = Histogram(
+            "check_duration_seconds",
+            "Duration of passed checks, including waiting for a connection.",
+            ("proto",),
+        )
+        self.in_flight = Gauge(
+            "checks_in_flight", "Checks started and not finished yet."
+        )
+        self.waiters = Gauge(
+            "connection_waiters",
+            "Checks waiting for a free connection, by funnel stage.",
+            ("stage",),
+        )
+        self.fetch_duration = Gauge(
+            "source_fetch_duration_seconds",
+            "How long the last fetch of the source took.",
+            ("proto", "source"),
+        )
+        self.source_proxies = Gauge(
+            "source_proxies",
+            "Proxies in the source when it was last fetched.",
+            ("proto", "source"),
+        )
+
+    def merge(self, other: "CheckerMetrics") -> None:
+        """Add counters and histograms of a worker process."""
+        for name, metric in vars(self).items():
+            metric.merge(getattr(other, name))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in vars(self).values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(
+                f"{name}{_format_labels(names, labels)}"
+                + f" {_format_value(value)}"
+                for name, names, labels, value in metric.samples()
+            )
+        return "\n".join(lines) + "\n"
+
+
+class MetricsProtocol(asyncio.Protocol):
+    """Answers GET /metrics with render() and closes the connection."""
+
+    def __init__(self, render: Callable[[], str]) -> None:
+        self.render = render
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def data_received(self, data: bytes) -> None:
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.buffer += data
+        end = self.buffer.find(b"\r\n\r\n")
+        if end == -1:
+            if len(self.buffer) > MAX_REQUEST_SIZE:
+                self.respond("431 Request Header Fields Too Large", b"")
+            return
+        parts = bytes(self.buffer[:end]).split(b"\r\n", 1)[0].split(b" ")
+        if len(parts) != 3 or parts[0] != b"GET":
+            self.respond("400 Bad Request", b"")
+        elif parts[1].split(b"?", 1)[0] != b"/metrics":
+            self.respond("404 Not Found", b"")
+        else:
+            self.respond("200 OK", self.render().encode())
+
+    def respond(self, status: str, body: bytes) -> None:
+        if self.transport is None:
+            return
+        self.transport.write(
+            (
+                f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}"
+                + f"\r\nContent-Type: {CONTENT_TYPE}\r\nConnection: close"
+                + "\r\n\r\n"
+            ).encode()
+            + body
+        )
+        self.transport.close()
+
+
+async def serve(
+    render: Callable[[], str], host: str = "127.0.0.1", port: int = 9100
+) -> asyncio.AbstractServer:
+    """Serve http://host:port/metrics on the running loop.
+
+    Args:
+        render (callable): Returns the metrics text for every request.
+        host (str): Address to listen on.
+        port (int): Port to listen on, 0 for any free one.
+    """
+    return await asyncio.get_running_loop().create_server(
+        lambda: MetricsProtocol(render), host, port
+    )
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Wall and CPU time of every phase of a run, optionally with a profiler.
+
+python main.py --profile - print the time of every phase
+python main.py --profile cprofile - also run cProfile over checking and
+save the stats for pstats/snakeviz
+python main.py --profile sampling - also sample the stack of the event loop
+thread while checking and save it in the collapsed format for
+flamegraph.pl/speedscope
+"""
+import cProfile
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from types import FrameType
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+PROFILE_MODES = ("timers", "cprofile", "sampling")
+
+# Files profilers are saved to by default.
+DEFAULT_OUTPUTS = {
+    "cprofile": "profile.pstats",
+    "sampling": "profile.collapsed",
+}
+
+
+def get_cpu_time() -> float:
+    """User and system time of the process and its finished children.
+
+    Children are worker processes, their time is counted once they exit.
+    """
+    times = os.times()
+    return (
+        times.user + times.system + times.children_user + times.children_system
+    )
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005) -> None:
+        """Sample the stack of the thread that starts it from another thread.
+
+        Unlike cProfile, it barely slows the checked code down, so timings
+        stay realistic. Samples are counted per unique stack.
+
+        Args:
+            interval (float): Seconds between samples.
+        """
+        self.INTERVAL = interval
+        self.stacks: "Counter[Tuple[str, ...]]" = Counter()
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def write(self, path: str) -> None:
+        """Save stacks as "outer;...;inner count" lines."""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.INTERVAL):
+            frame = sys._current_frames().get(self._thread_id or 0)
+            if frame is not None:
+                self.stacks[self._get_stack(frame)] += 1
+
+    @staticmethod
+    def _get_stack(frame: Optional[FrameType]) -> Tuple[str, ...]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                + f":{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+
+class PhaseProfiler:
+    def __init__(
+        self, mode: str = "timers", output: Optional[str] = None
+    ) -> None:
+        """Measure phases of a run with "with profiler.phase(name):".
+
+        Phases may be nested, e.g. geolocation inside saving. The time of a
+        nested phase is counted only for it, not for the outer one too, so
+        times add up to the total.
+
+        Args:
+            mode (str): "timers", "cprofile" or "sampling", see the module
+                docstring.
+            output (str): Where to save the profile, DEFAULT_OUTPUTS by
+                default.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.MODE = mode
+        self.OUTPUT = output or DEFAULT_OUTPUTS.get(mode)
+        # Phase -> [wall seconds, CPU seconds]
+        self.phases: Dict[str, List[float]] = {}
+        # Wall and CPU time of nested phases of the running ones.
+        self._nested: List[List[float]] = []
+        self._profiled: Optional[str] = None
+
+    @contextmanager
+    def phase(self, name: str, profile: bool = False) -> Iterator[None]:
+        """Measure the phase, times of repeated phases are added.
+
+        Args:
+            name (str): Phase name in the report.
+            profile (bool): Run the profiler of the mode over this phase.
+        """
+        profiler = self._start_profiler() if profile else None
+        if profiler is not None:
+            self._profiled = name
+        self._nested.append([0.0, 0.0])
+        wall, cpu = perf_counter(), get_cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = perf_counter() - wall, get_cpu_time() - cpu
+            nested_wall, nested_cpu = self._nested.pop()
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+            totals = self.phases.setdefault(name, [0.0, 0.0])
+            totals[0] += wall - nested_wall
+            totals[1] += cpu - nested_cpu
+            if profiler is not None:
+                self._stop_profiler(profiler)
+
+    def report(self, console: Console) -> None:
+        """Print the time of every phase and where the profile is saved."""
+        table = Table(title="Profile")
+        table.add_column("Phase", style="cyan")
+        table.add_column("Wall, s", style="magenta")
+        table.add_column("CPU, s", style="magenta")
+        table.add_column("CPU/Wall", style="green")
+        total_wall = total_cpu = 0.0
+        for name, (wall, cpu) in self.phases.items():
+            table.add_row(name, *self._format(wall, cpu))
+            total_wall += wall
+            total_cpu += cpu
+        table.add_row("total", *self._format(total_wall, total_cpu))
+        table.caption = (
+            "CPU/Wall near 100% is CPU-bound, near 0% is waiting for the"
+            + " network. CPU includes other threads and finished workers."
+        )
+        console.print(table)
+        if self._profiled is not None:
+            console.print(
+                f"[green]Profile of the {self._profiled} phase:"
+                + f" {self.OUTPUT}[/green]"
+            )
+
+    @staticmethod
+    def _format(wall: float, cpu: float) -> Tuple[str, str, str]:
+        share = f"{cpu / wall * 100:.0f}%" if wall > 0 else "-"
+        return f"{wall:.3f}", f"{cpu:.3f}", share
+
+    def _start_profiler(self) -> Optional[object]:
+        if self.MODE == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            return profile
+        if self.MODE == "sampling":
+            sampler = SamplingProfiler()
+            sampler.start()
+            return sampler
+        return None
+
+    def _stop_profiler(self, profiler: object) -> None:
+        output = self.OUTPUT or ""
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(output)
+        elif isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+            profiler.write(output)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Lean proxy checks on top of plain asyncio sockets.
+
+The SOCKS4, SOCKS5 and HTTP CONNECT handshakes are done by hand and the
+judge gets a minimal prebuilt request, so a check costs a few syscalls
+instead of a ClientSession, a connector and aiohttp's request machinery.
+"""
+import asyncio
+import socket
+from ssl import SSLContext
+from struct import pack
+from typing import Awaitable, Callable, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+# Upper bound for the proxy's handshake reply and the judge's response.
+MAX_RESPONSE_SIZE = 4096
+
+
+class ProxyError(Exception):
+    """The proxy refused to connect or sent an invalid reply."""
+
+
+class Judge(NamedTuple):
+    """IP_SERVICE resolved once per run."""
+
+    host: str
+    ip: str
+    port: int
+    ssl: bool
+    request: bytes
+
+
+async def resolve_judge(url: str) -> Judge:
+    """Parse the IP_SERVICE URL, resolve it and prebuild the request.
+
+    Args:
+        url (str): IP_SERVICE, http:// or https://.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in {"http", "https"} or not parts.hostname:
+        raise ValueError(f"Unsupported IP service: {url}")
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        parts.hostname, port, family=socket.AF_INET, type=socket.SOCK_STREAM
+    )
+    path = parts.path or "/"
+    if parts.query:
+        path += f"?{parts.query}"
+    host = parts.hostname if parts.port is None else f"{parts.hostname}:{port}"
+    # HTTP/1.0, so the judge can't answer with Transfer-Encoding: chunked.
+    request = (
+        f"GET {path} HTTP/1.0\r\nHost: {host}\r\nAccept: */*\r\n"
+        + "Connection: close\r\n\r\n"
+    ).encode()
+    return Judge(parts.hostname, infos[0][4][0], port, secure, request)
+
+
+async def check(
+    host: str,
+    port: int,
+    proto: str,
+    judge: Judge,
+    ssl_context: Optional[SSLContext] = None,
+) -> str:
+    """Get the judge's response body through the proxy.
+
+    Args:
+        host (str): Proxy's ip.
+        port (int): Proxy's port.
+        proto (str): http/socks4/socks5.
+        judge (Judge): Resolved IP_SERVICE.
+        ssl_context (SSLContext): Used if the judge is https.
+
+    Returns:
+        str: Response body, the proxy's exit node if it works.
+    """
+    sock = await connect(host, port)
+    try:
+        await handshake(sock, proto, judge)
+    except BaseException:
+        sock.close()
+        raise
+    return await fetch(sock, judge, ssl_context)
+
+
+async def connect(host: str, port: int) -> socket.socket:
+    """Open a non-blocking TCP connection to the proxy."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, (host, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def handshake(sock: socket.socket, proto: str, judge: Judge) -> None:
+    """Ask the proxy to open a tunnel to the judge.
+
+    Args:
+        sock (socket): Connected socket returned by connect().
+        proto (str): http/socks4/socks5.
+        judge (Judge): Resolved IP_SERVICE.
+    """
+    loop = asyncio.get_running_loop()
+    address = socket.inet_aton(judge.ip)
+    port = pack(">H", judge.port)
+    if proto == "socks5":
+        await loop.sock_sendall(sock, b"\x05\x01\x00")
+        if await _recv_exactly(sock, 2) != b"\x05\x00":
+            raise ProxyError("SOCKS5 authentication required")
+        await loop.sock_sendall(sock, b"\x05\x01\x00\x01" + address + port)
+        reply = await _recv_exactly(sock, 4)
+        if reply[0] != 5 or reply[1] != 0:
+            raise ProxyError(f"SOCKS5 reply code {reply[1]}")
+        if reply[3] == 1:
+            await _recv_exactly(sock, 6)
+        elif reply[3] == 3:
+            length = await _recv_exactly(sock, 1)
+            await _recv_exactly(sock, length[0] + 2)
+        elif reply[3] == 4:
+            await _recv_exactly(sock, 18)
+        else:
+            raise ProxyError(f"SOCKS5 address type {reply[3]}")
+    elif proto == "socks4":
+        await loop.sock_sendall(sock, b"\x04\x01" + port + address + b"\x00")
+        reply = await _recv_exactly(sock, 8)
+        if reply[0] != 0 or reply[1] != 0x5A:
+            raise ProxyError(f"SOCKS4 reply code {reply[1]}")
+    elif proto == "http":
+        target = f"{judge.host}:{judge.port}"
+        await loop.sock_sendall(
+            sock,
+            f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode(),
+        )
+        head = await _read_head(lambda n: loop.sock_recv(sock, n))
+        if head.split(b" ", 2)[1:2] != [b"200"]:
+            raise ProxyError(f"HTTP CONNECT: {head[:64]!r}")
+    else:
+        raise ValueError(f"Unsupported protocol: {proto}")
+
+
+async def fetch(
+    sock: socket.socket, judge: Judge, ssl_context: Optional[SSLContext] = None
+) -> str:
+    """Request the judge through an open tunnel and close the socket.
+
+    Args:
+        sock (socket): Socket after a successful handshake().
+        judge (Judge): Resolved IP_SERVICE.
+        ssl_context (SSLContext): Used if the judge is https.
+    """
+    if judge.ssl:
+        return await request_tls(sock, judge, ssl_context)
+    try:
+        return await request(sock, judge)
+    finally:
+        sock.close()
+
+
+async def request(sock: socket.socket, judge: Judge) -> str:
+    """Send the prebuilt request to a plain HTTP judge and read the body."""
+    loop = asyncio.get_running_loop()
+    await loop.sock_sendall(sock, judge.request)
+    return await _read_body(lambda n: loop.sock_recv(sock, n))
+
+
+async def request_tls(
+    sock: socket.socket, judge: Judge, ssl_context: Optional[SSLContext]
+) -> str:
+    """Same as request(), but for an https judge.
+
+    Takes ownership of the socket.
+    """
+    reader, writer = await asyncio.open_connection(
+        sock=sock, ssl=ssl_context or True, server_hostname=judge.host
+    )
+    try:
+        writer.write(judge.request)
+        return await _read_body(reader.read)
+    finally:
+        writer.transport.abort()
+
+
+async def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < n:
+        chunk = await loop.sock_recv(sock, n - len(data))
+        if not chunk:
+            raise ProxyError("Connection closed by proxy")
+        data += chunk
+    return data
+
+
+async def _read_head(recv: Callable[[int], Awaitable[bytes]]) -> bytes:
+    """Read until the end of HTTP headers, return everything read."""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        if len(data) >= MAX_RESPONSE_SIZE:
+            raise ProxyError("Response headers are too large")
+        chunk = await recv(MAX_RESPONSE_SIZE - len(data))
+        if not chunk:
+            raise ProxyError("Connection closed before headers")
+        data += chunk
+    return data
+
+
+async def _read_body(recv: Callable[[int], Awaitable[bytes]]) -> str:
+    """Read a small HTTP response and return its body.
+
+    Stops as soon as Content-Length bytes have arrived, otherwise reads
+    until the connection is closed.
+    """
+    data = await _read_head(recv)
+    head, _, body = data.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    if lines[0].split(b" ", 2)[1:2] != [b"200"]:
+        raise ProxyError(f"Judge: {lines[0][:64]!r}")
+    length: Optional[int] = None
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+            break
+    while length is None or len(body) < length:
+        if len(body) >= MAX_RESPONSE_SIZE:
+            raise ProxyError("Response body is too large")
+        chunk = await recv(MAX_RESPONSE_SIZE - len(body))
+        if not chunk:
+            break
+        body += chunk
+    if length is not None:
+        body = body[:length]
+    return body.decode("utf-8", "replace")
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Proxy lists of sources from previous runs, stored in a JSON file."""
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from store import format_proxy, parse_proxy
+
+
+class CachedSource(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+    # (IPv4 address as an int, port), like find_proxies() returns them.
+    proxies: List[Tuple[int, int]]
+
+    def get_headers(self) -> Dict[str, str]:
+        """Headers for a conditional GET of the source."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class SourceCache:
+    def __init__(self, path: str) -> None:
+        """Load the cache, a missing or broken file is an empty cache.
+
+        Proxies are stored as ip:port strings in the file.
+
+        Args:
+            path (str): Path to the JSON file.
+        """
+        self.path = path
+        self.sources: Dict[str, Dict[str, CachedSource]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.sources = {
+                proto: {
+                    url: CachedSource(
+                        *entry[:3], [parse_proxy(proxy) for proxy in entry[3]]
+                    )
+                    for url, entry in urls.items()
+                }
+                for proto, urls in data.items()
+            }
+        except (OSError, ValueError, TypeError):
+            pass
+
+    def get(self, proto: str, url: str) -> Optional[CachedSource]:
+        return self.sources.get(proto, {}).get(url)
+
+    def set(self, proto: str, url: str, source: CachedSource) -> None:
+        self.sources.setdefault(proto, {})[url] = source
+
+    def save(self) -> None:
+        """Write the cache to a temporary file and replace the old one."""
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    proto: {
+                        url: [
+                            *source[:3],
+                            [format_proxy(*proxy) for proxy in source.proxies],
+                        ]
+                        for url, source in urls.items()
+                    }
+                    for proto, urls in self.sources.items()
+                },
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp, self.path)
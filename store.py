@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Compact storage of proxies of one protocol in typed arrays."""
+import re
+import socket
+from array import array
+from functools import lru_cache
+from ipaddress import IPv4Address
+from typing import (
+    ItemsView,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Pattern,
+    Tuple,
+    ValuesView,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore[assignment]
+
+# Statuses of rows. Unchecked and working proxies are in the mapping, the
+# others are only remembered so they aren't added again.
+UNCHECKED = 0
+WORKING = 1
+DEAD = 2
+SKIPPED = 3
+
+# Unsigned 32-bit array type code.
+U32 = "I" if array("I").itemsize == 4 else "L"
+
+# Octets up to 255 without leading zeros like IPv4Address, ports up to 65535.
+# Leading zeros of the port aren't captured, so groups are normalized.
+_OCTET = "(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+_PORT = (
+    "(?:6553[0-5]|655[0-2][0-9]|65[0-4][0-9]{2}|6[0-4][0-9]{3}"
+    + "|[1-5][0-9]{4}|[1-9][0-9]{0,3}|0)"
+)
+_PROXY = re.compile(
+    rf"({_OCTET})\.({_OCTET})\.({_OCTET})\.({_OCTET}):0*({_PORT})"
+)
+
+# Fibonacci hashing spreads ip:port keys with common ports over the index.
+_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+
+def parse_proxy(proxy: str) -> Tuple[int, int]:
+    """Split ip:port into the IPv4 address as an int and the port.
+
+    Raises:
+        ValueError: If it isn't a normalized IPv4 ip:port.
+    """
+    match = _PROXY.fullmatch(proxy)
+    if match is None:
+        raise ValueError(f"Invalid proxy: {proxy}")
+    a, b, c, d, port = match.groups()
+    return int(a) << 24 | int(b) << 16 | int(c) << 8 | int(d), int(port)
+
+
+@lru_cache(maxsize=None)
+def _get_list_pattern(proto: str) -> "Pattern[bytes]":
+    ip = rf"{_OCTET}\.{_OCTET}\.{_OCTET}\.{_OCTET}".encode()
+    return re.compile(
+        rb"^[ \t]*(?:"
+        + re.escape(proto.encode())
+        + rb"://|https://)?("
+        + ip
+        + rb"):0*("
+        + _PORT.encode()
+        + rb")[ \t]*\r?$",
+        re.MULTILINE,
+    )
+
+
+def find_proxies(data: bytes, proto: str) -> List[Tuple[int, int]]:
+    """Get proxies from a proxy list in a single regex pass.
+
+    Args:
+        data (bytes): Proxy list, one proxy per line, optionally with
+            proto:// or https:// in front of it. Other lines are ignored.
+        proto (str): http/socks4/socks5.
+
+    Returns:
+        (IPv4 address as an int, port) in the order they are in the list,
+        like parse_proxy() returns them.
+    """
+    inet_aton, from_bytes = socket.inet_aton, int.from_bytes
+    return [
+        (from_bytes(inet_aton(ip.decode("ascii")), "big"), int(port))
+        for ip, port in _get_list_pattern(proto).findall(data)
+    ]
+
+
+def format_proxy(ip: int, port: int) -> str:
+    return f"{socket.inet_ntoa(ip.to_bytes(4, 'big'))}:{port}"
+
+
+def _format_exit_node(exit_node: int) -> str:
+    return socket.inet_ntoa(exit_node.to_bytes(4, "big")) if exit_node else ""
+
+
+class _ItemsView(ItemsView[str, Optional[str]]):
+    _mapping: "ProxyStore"
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[str]]]:
+        store = self._mapping
+        for row, status in enumerate(store.statuses):
+            if status == UNCHECKED:
+                yield store.key_at(row), None
+            elif status == WORKING:
+                yield store.key_at(row), _format_exit_node(
+                    store.exit_nodes[row]
+                )
+
+
+class _ValuesView(ValuesView[Optional[str]]):
+    _mapping: "ProxyStore"
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        for _, exit_node in _ItemsView(self._mapping):
+            yield exit_node
+
+
+class ProxyStore(MutableMapping[str, Optional[str]]):
+    def __init__(self, proxies: Iterable[str] = ()) -> None:
+        """ip:port -> exit node (None if not checked yet), like a dict.
+
+        Every proxy takes a row of parallel arrays: the address, the port,
+        the exit node and the status, about 11 bytes instead of a few
+        hundred for a str key in a dict and a set. Strings are only created
+        when proxies are iterated over. An open addressing index of row
+        numbers keeps lookups O(1). Deleted proxies keep their row as DEAD,
+        so add() can tell they were already seen.
+
+        Args:
+            proxies (Iterable): ip:port of unchecked proxies.
+        """
+        self.clear()
+        for proxy in proxies:
+            self.add(proxy, UNCHECKED)
+
+    @classmethod
+    def from_items(
+        cls, items: Iterable[Tuple[str, Optional[str]]]
+    ) -> "ProxyStore":
+        """Like dict(items), e.g. to keep proxies in a sorted order."""
+        store = cls()
+        for proxy, exit_node in items:
+            store[proxy] = exit_node
+        return store
+
+    @property
+    def total(self) -> int:
+        """Number of proxies ever added, including dead and skipped ones."""
+        return len(self.statuses)
+
+    def add(self, proxy: str, status: int = UNCHECKED) -> bool:
+        """Add a proxy that wasn't added before.
+
+        Args:
+            proxy (str): ip:port.
+            status (int): UNCHECKED or SKIPPED (seen, but not in the mapping).
+
+        Returns:
+            bool: False if the proxy was already added, whatever its status.
+
+        Raises:
+            ValueError: If it isn't a valid IPv4 ip:port.
+        """
+        ip, port = parse_proxy(proxy)
+        return self.add_packed(ip, port, status)
+
+    def add_packed(self, ip: int, port: int, status: int = UNCHECKED) -> bool:
+        """Like add(), but with the proxy as parse_proxy() returns it.
+
+        The proxy isn't validated, find_proxies() only returns valid ones.
+        """
+        slot, row = self._lookup(ip, port)
+        if row >= 0:
+            return False
+        self._index[slot] = len(self.statuses) + 1
+        self.ips.append(ip)
+        self.ports.append(port)
+        self.exit_nodes.append(0)
+        self.statuses.append(status)
+        if status <= WORKING:
+            self._live += 1
+        if len(self.statuses) * 2 > len(self._index):
+            self._resize()
+        return True
+
+    def items(self) -> ItemsView[str, Optional[str]]:
+        """Like Mapping.items(), but reads the rows without lookups."""
+        return _ItemsView(self)
+
+    def values(self) -> ValuesView[Optional[str]]:
+        return _ValuesView(self)
+
+    def sorted(self) -> "ProxyStore":
+        """Copy of the mapping in ip:port order, without dead proxies.
+
+        Every row is sorted by a packed ip << 16 | port integer: with a
+        NumPy argsort if NumPy is installed, otherwise with sorted() on ints
+        that also carry the row number in the low 32 bits.
+        """
+        if numpy is not None:
+            statuses = numpy.frombuffer(self.statuses, dtype=numpy.uint8)
+            live = numpy.flatnonzero(statuses <= WORKING)
+            ips = numpy.frombuffer(self.ips, dtype=numpy.uint32)[live]
+            ports = numpy.frombuffer(self.ports, dtype=numpy.uint16)[live]
+            keys = ips.astype(numpy.uint64) << numpy.uint64(16) | ports
+            order = live[numpy.argsort(keys)]
+            store = type(self)()
+            for name in ("ips", "ports", "exit_nodes", "statuses"):
+                column = getattr(self, name)
+                dtype = numpy.dtype(f"u{column.itemsize}")
+                getattr(store, name).frombytes(
+                    numpy.frombuffer(column, dtype=dtype)[order].tobytes()
+                )
+        else:
+            keys = sorted(
+                (ip << 16 | port) << 32 | row
+                for row, (ip, port, status) in enumerate(
+                    zip(self.ips, self.ports, self.statuses)
+                )
+                if status <= WORKING
+            )
+            store = type(self)()
+            store.ips = array(U32, [key >> 48 for key in keys])
+            store.ports = array("H", [key >> 32 & 0xFFFF for key in keys])
+            exit_nodes, statuses = self.exit_nodes, self.statuses
+            store.exit_nodes = array(
+                U32, [exit_nodes[key & 0xFFFFFFFF] for key in keys]
+            )
+            store.statuses = array(
+                "B", [statuses[key & 0xFFFFFFFF] for key in keys]
+            )
+        store._live = len(store.statuses)
+        # The index is built on the first lookup, sorted copies are usually
+        # only written out.
+        while len(store.statuses) * 2 > 1 << store._bits:
+            store._bits += 1
+        store._index = array("i")
+        return store
+
+    def key_at(self, row: int) -> str:
+        return format_proxy(self.ips[row], self.ports[row])
+
+    def live_rows(self) -> "array[int]":
+        """Rows of unchecked and working proxies."""
+        return array(
+            U32,
+            (
+                row
+                for row, status in enumerate(self.statuses)
+                if status <= WORKING
+            ),
+        )
+
+    def __getitem__(self, proxy: str) -> Optional[str]:
+        row = self._find(proxy)
+        if row < 0 or self.statuses[row] > WORKING:
+            raise KeyError(proxy)
+        if self.statuses[row] == UNCHECKED:
+            return None
+        return _format_exit_node(self.exit_nodes[row])
+
+    def __setitem__(self, proxy: str, exit_node: Optional[str]) -> None:
+        """Mark the proxy as working with the exit node, or unchecked if None.
+
+        An empty exit node means it is unknown.
+        """
+        row = self._find(proxy)
+        if row < 0:
+            self.add(proxy, UNCHECKED)
+            row = len(self.statuses) - 1
+        if self.statuses[row] > WORKING:
+            self._live += 1
+        if exit_node is None:
+            self.statuses[row] = UNCHECKED
+            self.exit_nodes[row] = 0
+        else:
+            self.statuses[row] = WORKING
+            self.exit_nodes[row] = (
+                int(IPv4Address(exit_node)) if exit_node else 0
+            )
+
+    def __delitem__(self, proxy: str) -> None:
+        row = self._find(proxy)
+        if row < 0 or self.statuses[row] > WORKING:
+            raise KeyError(proxy)
+        self.statuses[row] = DEAD
+        self._live -= 1
+
+    def __contains__(self, proxy: object) -> bool:
+        if not isinstance(proxy, str):
+            return False
+        row = self._find(proxy)
+        return row >= 0 and self.statuses[row] <= WORKING
+
+    def __iter__(self) -> Iterator[str]:
+        ips, ports = self.ips, self.ports
+        for row, status in enumerate(self.statuses):
+            if status <= WORKING:
+                yield format_proxy(ips[row], ports[row])
+
+    def __len__(self) -> int:
+        return self._live
+
+    def clear(self) -> None:
+        """Forget all proxies, including dead and skipped ones."""
+        self.ips = array(U32)
+        self.ports = array("H")
+        self.exit_nodes = array(U32)
+        self.statuses = array("B")
+        self._bits = 3
+        self._index = array("i", bytes(4 << self._bits))
+        self._live = 0
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self)}/{self.total})"
+
+    def _find(self, proxy: str) -> int:
+        try:
+            ip, port = parse_proxy(proxy)
+        except ValueError:
+            return -1
+        return self._lookup(ip, port)[1]
+
+    def _lookup(self, ip: int, port: int) -> Tuple[int, int]:
+        """Slot of the proxy in the index and its row, -1 if it is absent."""
+        index = self._index
+        if not index:
+            index = self._reindex()
+        ips, ports = self.ips, self.ports
+        mask = len(index) - 1
+        slot = ((ip << 16 | port) * _MULTIPLIER & _MASK) >> 64 - self._bits
+        while True:
+            row = index[slot] - 1
+            if row < 0 or (ips[row] == ip and ports[row] == port):
+                return slot, row
+            slot = (slot + 1) & mask
+
+    def _resize(self) -> None:
+        self._bits += 1
+        self._reindex()
+
+    def _reindex(self) -> "array[int]":
+        index = self._index = array("i", bytes(4 << self._bits))
+        mask = len(index) - 1
+        shift = 64 - self._bits
+        for row, (ip, port) in enumerate(zip(self.ips, self.ports)):
+            slot = ((ip << 16 | port) * _MULTIPLIER & _MASK) >> shift
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = row + 1
+        return index